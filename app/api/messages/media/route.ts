@@ -0,0 +1,130 @@
+import { NextRequest, NextResponse } from 'next/server'
+import { cookies } from 'next/headers'
+import { verifyToken } from '@/lib/auth'
+import { getUserById } from '@/lib/db'
+import { spawn } from 'child_process'
+import { createReadStream } from 'fs'
+import { Readable } from 'stream'
+import path from 'path'
+
+// Serves MMS media from the Python service's disk cache, downloading it from TextNow only once
+export async function GET(request: NextRequest) {
+  try {
+    const cookieStore = await cookies()
+    const token = cookieStore.get('auth-token')?.value
+
+    if (!token) {
+      return NextResponse.json(
+        { error: 'Unauthorized' },
+        { status: 401 }
+      )
+    }
+
+    const authData = verifyToken(token)
+    if (!authData) {
+      return NextResponse.json(
+        { error: 'Invalid token' },
+        { status: 401 }
+      )
+    }
+
+    const user = getUserById(authData.userId)
+    if (!user) {
+      return NextResponse.json(
+        { error: 'User not found' },
+        { status: 404 }
+      )
+    }
+
+    const { searchParams } = new URL(request.url)
+    const mediaUrl = searchParams.get('url')
+    if (!mediaUrl) {
+      return NextResponse.json(
+        { error: 'Missing url' },
+        { status: 400 }
+      )
+    }
+
+    const pythonCmd = process.platform === 'win32' ? 'python' : 'python3'
+    const pythonProcess = spawn(pythonCmd, [
+      path.join(process.cwd(), 'python_service.py'),
+      'fetch_media'
+    ], {
+      cwd: process.cwd(),
+      env: process.env
+    })
+
+    pythonProcess.stdin.write(JSON.stringify({
+      username: user.textnowUsername,
+      sid_cookie: user.sidCookie,
+      user_agent: user.userAgent || undefined,  // User agent from browser (required per GitHub issue #39)
+      url: mediaUrl,
+    }))
+    pythonProcess.stdin.end()
+
+    let output = ''
+    pythonProcess.stdout.on('data', (data) => {
+      output += data.toString()
+    })
+
+    const result = await new Promise<string>((resolve, reject) => {
+      pythonProcess.on('close', (code) => {
+        if (code === 0 && output.trim()) {
+          resolve(output)
+        } else {
+          reject(new Error(`Python process exited with code ${code}: ${output || 'no output'}`))
+        }
+      })
+      pythonProcess.on('error', (err) => {
+        reject(new Error(`Failed to start Python process: ${err.message}`))
+      })
+    })
+
+    const media = JSON.parse(result.trim())
+    if (media.error) {
+      return NextResponse.json({ error: media.error }, { status: 502 })
+    }
+
+    // The file is content-addressed: its hash is a permanent ETag
+    const etag = `"${media.sha256}"`
+    if (request.headers.get('if-none-match') === etag) {
+      return new Response(null, { status: 304, headers: { ETag: etag } })
+    }
+
+    const size: number = media.size
+    const headers: Record<string, string> = {
+      'Content-Type': media.content_type || 'application/octet-stream',
+      'Accept-Ranges': 'bytes',
+      'ETag': etag,
+      'Cache-Control': 'private, max-age=31536000, immutable',
+    }
+
+    // Single byte range (bytes=start-end, start-, or -suffix); anything else gets the whole file
+    let start = 0
+    let end = size - 1
+    let status = 200
+    const range = /^bytes=(\d*)-(\d*)$/.exec(request.headers.get('range') || '')
+    if (range && (range[1] || range[2])) {
+      if (range[1]) {
+        start = parseInt(range[1], 10)
+        end = range[2] ? Math.min(parseInt(range[2], 10), size - 1) : size - 1
+      } else {
+        start = Math.max(0, size - parseInt(range[2], 10))
+      }
+      if (start > end || start >= size) {
+        return new Response(null, { status: 416, headers: { 'Content-Range': `bytes */${size}` } })
+      }
+      status = 206
+      headers['Content-Range'] = `bytes ${start}-${end}/${size}`
+    }
+    headers['Content-Length'] = String(Math.max(0, end - start + 1))
+
+    const stream = size ? createReadStream(media.path, { start, end }) : Readable.from([])
+    return new Response(Readable.toWeb(stream) as ReadableStream, { status, headers })
+  } catch (error: any) {
+    return NextResponse.json(
+      { error: error.message || 'Failed to fetch media' },
+      { status: 500 }
+    )
+  }
+}
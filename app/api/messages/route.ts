@@ -40,6 +40,7 @@ export async function GET(request: NextRequest) {
     // Call Python service to get messages
     // Try 'python' first, fallback to 'python3' if needed
     const pythonCmd = process.platform === 'win32' ? 'python' : 'python3'
+    const spawnedAt = Date.now()
     const pythonProcess = spawn(pythonCmd, [
       path.join(process.cwd(), 'python_service.py'),
       'get_messages'
@@ -54,6 +55,9 @@ export async function GET(request: NextRequest) {
       user_agent: user.userAgent || undefined,  // User agent from browser (required per GitHub issue #39)
       number: phoneNumber || null,
       num_messages: 200,  // Increased to get more messages
+      diagnostics: process.env.TEXTNOW_DIAGNOSTICS === 'request' || undefined,  // Opt-in debug info
+      timings: process.env.TEXTNOW_TIMINGS === '1' || undefined,  // Per-phase timings, incl. process startup
+      spawned_at: spawnedAt,
     }
 
     let output = ''
@@ -108,20 +112,18 @@ export async function GET(request: NextRequest) {
         })
       }
       
-      // Filter out debug messages and errors, but log debug info
+      // Diagnostics are opt-in and arrive next to the messages, not inside them
       const allMessages = parsed.messages || []
-      const debugInfo = allMessages.find((m: any) => m.debug)?.debug
+      const debugInfo = parsed.diagnostics
       
       if (debugInfo) {
         console.log('DEBUG INFO from Python service:', JSON.stringify(debugInfo, null, 2))
       }
+      if (parsed.timings) {
+        console.log('Python service timings:', JSON.stringify(parsed.timings))
+      }
       
-      const messages = allMessages.filter((msg: any) => {
-        if (msg.debug) {
-          return false // Don't include debug in messages
-        }
-        return !msg.error // Filter out error messages
-      })
+      const messages = allMessages.filter((msg: any) => !msg.error) // Filter out error messages
       
       return NextResponse.json({
         messages: messages,
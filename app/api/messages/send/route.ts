@@ -34,7 +34,7 @@ export async function POST(request: NextRequest) {
       )
     }
 
-    const { number, message } = await request.json()
+    const { number, message, idempotencyKey } = await request.json()
 
     if (!number || !message) {
       return NextResponse.json(
@@ -57,9 +57,11 @@ export async function POST(request: NextRequest) {
     // Call Python service to send message
     // Try 'python' first, fallback to 'python3' if needed
     const pythonCmd = process.platform === 'win32' ? 'python' : 'python3'
+    // With TEXTNOW_OUTBOX=1 the message is queued durably and delivered in the background
+    const useOutbox = process.env.TEXTNOW_OUTBOX === '1'
     const pythonProcess = spawn(pythonCmd, [
       path.join(process.cwd(), 'python_service.py'),
-      'send_sms'
+      useOutbox ? 'enqueue_sms' : 'send_sms'
     ], {
       cwd: process.cwd(),
       env: process.env
@@ -71,6 +73,7 @@ export async function POST(request: NextRequest) {
       user_agent: user.userAgent || undefined,  // User agent from browser (required per GitHub issue #39)
       number: phoneNumber,
       message: message,
+      idempotency_key: idempotencyKey || request.headers.get('Idempotency-Key') || undefined,
     }
 
     let output = ''
@@ -116,6 +119,27 @@ export async function POST(request: NextRequest) {
       const jsonString = jsonMatch ? jsonMatch[0] : cleanedOutput
       
       const parsed = JSON.parse(jsonString)
+
+      if (useOutbox && parsed.job_id) {
+        // Deliver in a detached process; the job survives if it dies
+        const deliverer = spawn(pythonCmd, [
+          path.join(process.cwd(), 'python_service.py'),
+          'process_outbox'
+        ], {
+          cwd: process.cwd(),
+          env: process.env,
+          detached: true,
+          stdio: ['pipe', 'ignore', 'ignore'],
+        })
+        deliverer.stdin?.end('{}')
+        deliverer.unref()
+        return NextResponse.json({
+          success: true,
+          queued: true,
+          jobId: parsed.job_id,
+          message: 'Message queued',
+        })
+      }
       
       if (parsed.success) {
         return NextResponse.json({
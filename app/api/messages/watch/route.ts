@@ -0,0 +1,77 @@
+import { NextRequest, NextResponse } from 'next/server'
+import { cookies } from 'next/headers'
+import { verifyToken } from '@/lib/auth'
+import { getUserById } from '@/lib/db'
+import { spawn } from 'child_process'
+import path from 'path'
+
+// Streams new and changed messages as NDJSON events instead of re-polling GET /api/messages
+export async function GET(request: NextRequest) {
+  const cookieStore = await cookies()
+  const token = cookieStore.get('auth-token')?.value
+
+  if (!token) {
+    return NextResponse.json(
+      { error: 'Unauthorized' },
+      { status: 401 }
+    )
+  }
+
+  const authData = verifyToken(token)
+  if (!authData) {
+    return NextResponse.json(
+      { error: 'Invalid token' },
+      { status: 401 }
+    )
+  }
+
+  const user = getUserById(authData.userId)
+  if (!user) {
+    return NextResponse.json(
+      { error: 'User not found' },
+      { status: 404 }
+    )
+  }
+
+  const { searchParams } = new URL(request.url)
+  const phoneNumber = searchParams.get('phoneNumber')
+
+  const pythonCmd = process.platform === 'win32' ? 'python' : 'python3'
+  const pythonProcess = spawn(pythonCmd, [
+    path.join(process.cwd(), 'python_service.py'),
+    'watch'
+  ], {
+    cwd: process.cwd(),
+    env: process.env
+  })
+
+  pythonProcess.stdin.write(JSON.stringify({
+    username: user.textnowUsername,
+    sid_cookie: user.sidCookie,
+    user_agent: user.userAgent || undefined,  // User agent from browser (required per GitHub issue #39)
+    number: phoneNumber || null,
+    num_messages: 200,
+  }))
+  pythonProcess.stdin.end()
+
+  // Stop polling upstream as soon as the client goes away
+  request.signal.addEventListener('abort', () => pythonProcess.kill())
+
+  const stream = new ReadableStream({
+    start(controller) {
+      pythonProcess.stdout.on('data', (data) => controller.enqueue(data))
+      pythonProcess.on('close', () => controller.close())
+      pythonProcess.on('error', (err) => controller.error(err))
+    },
+    cancel() {
+      pythonProcess.kill()
+    },
+  })
+
+  return new Response(stream, {
+    headers: {
+      'Content-Type': 'application/x-ndjson',
+      'Cache-Control': 'no-cache',
+    },
+  })
+}
@@ -0,0 +1,84 @@
+import { NextRequest, NextResponse } from 'next/server'
+import { cookies } from 'next/headers'
+import { verifyToken } from '@/lib/auth'
+import { getUserById } from '@/lib/db'
+import { spawn } from 'child_process'
+import path from 'path'
+
+// Whether the saved TextNow cookie still works; recent verdicts are cached by the Python service
+export async function GET(request: NextRequest) {
+  try {
+    const cookieStore = await cookies()
+    const token = cookieStore.get('auth-token')?.value
+
+    if (!token) {
+      return NextResponse.json(
+        { error: 'Unauthorized' },
+        { status: 401 }
+      )
+    }
+
+    const authData = verifyToken(token)
+    if (!authData) {
+      return NextResponse.json(
+        { error: 'Invalid token' },
+        { status: 401 }
+      )
+    }
+
+    const user = getUserById(authData.userId)
+    if (!user) {
+      return NextResponse.json(
+        { error: 'User not found' },
+        { status: 404 }
+      )
+    }
+
+    if (!user.textnowUsername || !user.sidCookie) {
+      return NextResponse.json({ valid: false, error: 'TextNow credentials not configured' })
+    }
+
+    const { searchParams } = new URL(request.url)
+    const pythonCmd = process.platform === 'win32' ? 'python' : 'python3'
+    const pythonProcess = spawn(pythonCmd, [
+      path.join(process.cwd(), 'python_service.py'),
+      'check_session'
+    ], {
+      cwd: process.cwd(),
+      env: process.env
+    })
+
+    pythonProcess.stdin.write(JSON.stringify({
+      username: user.textnowUsername,
+      sid_cookie: user.sidCookie,
+      user_agent: user.userAgent || undefined,  // User agent from browser (required per GitHub issue #39)
+      force: searchParams.get('force') === '1' || undefined,
+    }))
+    pythonProcess.stdin.end()
+
+    let output = ''
+    pythonProcess.stdout.on('data', (data) => {
+      output += data.toString()
+    })
+
+    const result = await new Promise<string>((resolve, reject) => {
+      pythonProcess.on('close', (code) => {
+        if (code === 0 && output.trim()) {
+          resolve(output)
+        } else {
+          reject(new Error(`Python process exited with code ${code}: ${output || 'no output'}`))
+        }
+      })
+      pythonProcess.on('error', (err) => {
+        reject(new Error(`Failed to start Python process: ${err.message}`))
+      })
+    })
+
+    return NextResponse.json(JSON.parse(result.trim()))
+  } catch (error: any) {
+    return NextResponse.json(
+      { valid: false, error: error.message || 'Failed to check session' },
+      { status: 500 }
+    )
+  }
+}
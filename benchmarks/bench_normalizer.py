@@ -0,0 +1,51 @@
+"""
+Micro-benchmark for normalizing the all-messages payload
+
+Compares the per-message fallback chains (normalize_raw_message) with the
+schema-learning MessageNormalizer over synthetic TextNow-shaped payloads.
+
+Usage:
+    python3 benchmarks/bench_normalizer.py              # 10k and 100k messages
+    python3 benchmarks/bench_normalizer.py --sizes 50000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import python_service  # noqa: E402
+from fake_textnow import synthetic_messages  # noqa: E402
+
+
+def run(label: str, normalize, messages: list, repeat: int) -> list:
+    elapsed = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [normalize(m) for m in messages]
+        elapsed = min(elapsed, time.perf_counter() - start)
+    print(f"  {label:<10} {elapsed * 1000:9.1f}ms  {len(messages) / elapsed:12,.0f} msg/s")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3, help='report the best of N runs')
+    args = parser.parse_args()
+
+    username = 'benchuser'
+    for size in args.sizes:
+        messages = synthetic_messages(size, username, contacts=10000)
+        print(f"{size:,} messages")
+        slow = run('fallback', lambda m: python_service.normalize_raw_message(m, username), messages, args.repeat)
+        normalizer = python_service.MessageNormalizer(username)
+        fast = run('compiled', normalizer.normalize, messages, args.repeat)
+        assert slow == fast, 'compiled normalizer output differs from the fallback chains'
+        print(f"  compiled rows: {normalizer.fast // args.repeat:,}  fallback rows: {normalizer.slow // args.repeat:,}")
+
+
+if __name__ == '__main__':
+    main()
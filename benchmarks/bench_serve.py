@@ -0,0 +1,87 @@
+"""
+Compare per-request latency of the spawn-per-call model against `serve` mode
+
+Usage:
+    python3 benchmarks/bench_serve.py                      # ping round trips
+    python3 benchmarks/bench_serve.py -n 20 --command get_messages --input request.json
+
+`--input` is a JSON file with the usual command payload (username, sid_cookie, ...).
+Without it the `ping` command is used, which isolates the per-process overhead
+(interpreter startup, imports, client setup) that serve mode removes.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SERVICE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_service.py')
+
+
+def summarize(label: str, samples: list) -> None:
+    samples_ms = sorted(s * 1000 for s in samples)
+    p95 = samples_ms[min(len(samples_ms) - 1, int(len(samples_ms) * 0.95))]
+    print(f"{label:<8} n={len(samples_ms):<5} p50={statistics.median(samples_ms):8.2f}ms "
+          f"p95={p95:8.2f}ms mean={statistics.mean(samples_ms):8.2f}ms")
+
+
+def bench_spawn(command: str, payload: dict, iterations: int) -> list:
+    samples = []
+    body = json.dumps(payload).encode()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, SERVICE, command], input=body,
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=False)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_serve(command: str, payload: dict, iterations: int) -> list:
+    samples = []
+    worker = subprocess.Popen([sys.executable, SERVICE, 'serve'], stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=1)
+    try:
+        # The first round trip pays the one-off startup; keep it out of the samples
+        start = time.perf_counter()
+        worker.stdin.write(json.dumps({'id': 'warmup', 'command': 'ping'}) + '\n')
+        worker.stdin.flush()
+        worker.stdout.readline()
+        print(f"serve startup {(time.perf_counter() - start) * 1000:.2f}ms (paid once)")
+
+        for i in range(iterations):
+            request = dict(payload, id=i, command=command)
+            start = time.perf_counter()
+            worker.stdin.write(json.dumps(request) + '\n')
+            worker.stdin.flush()
+            worker.stdout.readline()
+            samples.append(time.perf_counter() - start)
+    finally:
+        worker.stdin.close()
+        worker.wait(timeout=10)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--iterations', type=int, default=50)
+    parser.add_argument('--command', default='ping')
+    parser.add_argument('--input', help='JSON file with the command payload')
+    args = parser.parse_args()
+
+    payload = {}
+    if args.input:
+        with open(args.input) as f:
+            payload = json.load(f)
+
+    spawn = bench_spawn(args.command, payload, args.iterations)
+    served = bench_serve(args.command, payload, args.iterations)
+    summarize('spawn', spawn)
+    summarize('serve', served)
+    print(f"speedup  p50 x{statistics.median(spawn) / statistics.median(served):.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Multi-account throughput of one `serve` process against `supervise` with several
+
+Many accounts run full-sync get_messages at once against the local fake API,
+so the work is dominated by parsing and normalization, which one process
+runs on one core (GIL) and the supervisor spreads over its processes.
+
+Usage:
+    python3 benchmarks/bench_supervise.py
+    python3 benchmarks/bench_supervise.py --workers 4 --accounts 16 --messages 3000
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE = os.path.join(BENCH_DIR, '..', 'python_service.py')
+
+from fake_textnow import FakeTextNow  # noqa: E402
+
+
+def run(mode: str, env: dict, accounts: int, messages: int, rounds: int) -> float:
+    """Messages per second for `rounds` full syncs of every account, all in flight at once"""
+    worker = subprocess.Popen([sys.executable, SERVICE, mode], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True, bufsize=1, env=env)
+    try:
+        worker.stdin.write(json.dumps({'id': 'warmup', 'command': 'ping'}) + '\n')
+        worker.stdin.flush()
+        worker.stdout.readline()
+
+        requests = [{'id': f'{n}-{i}', 'command': 'get_messages', 'username': f'account{i}',
+                     'sid_cookie': f'sid{i}', 'num_messages': messages, 'full_sync': True}
+                    for n in range(rounds) for i in range(accounts)]
+        start = time.perf_counter()
+        for request in requests:
+            worker.stdin.write(json.dumps(request) + '\n')
+        worker.stdin.flush()
+        for _ in requests:
+            response = json.loads(worker.stdout.readline())
+            if 'error' in response:
+                raise RuntimeError(f"{mode}: {response['error']}")
+        elapsed = time.perf_counter() - start
+    finally:
+        worker.stdin.close()
+        worker.wait(timeout=30)
+    return len(requests) * messages / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument('--accounts', type=int, default=8)
+    parser.add_argument('--messages', type=int, default=2000, help='history size per account')
+    parser.add_argument('--rounds', type=int, default=2)
+    args = parser.parse_args()
+
+    fake = FakeTextNow(messages=args.messages, seed=0).start()
+    try:
+        with tempfile.TemporaryDirectory() as data_dir:
+            env = dict(os.environ, TEXTNOW_BASE_URL=fake.url, TEXTNOW_DATA_DIR=data_dir, TEXTNOW_REQUEST_RATE='0',
+                       TEXTNOW_MAX_PAGES='100000', TEXTNOW_MESSAGES_CACHE_TTL='0',
+                       TEXTNOW_SUPERVISE_WORKERS=str(args.workers), TEXTNOW_SUPERVISE_MAX_QUEUE='100000')
+            served = run('serve', env, args.accounts, args.messages, args.rounds)
+            supervised = run('supervise', env, args.accounts, args.messages, args.rounds)
+    finally:
+        fake.stop()
+    print(f"serve      {served:12,.0f} msg/s (1 process)")
+    print(f"supervise  {supervised:12,.0f} msg/s ({args.workers} processes)")
+    print(f"speedup    x{supervised / served:.1f}")
+
+
+if __name__ == '__main__':
+    main()
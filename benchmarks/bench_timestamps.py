@@ -0,0 +1,82 @@
+"""
+Micro-benchmark for message date normalization
+
+Compares the previous per-value normalize_date_value (naive local time, three
+strptime formats) with TimestampParser over the date shapes seen in payloads,
+reporting the cost per 100k timestamps.
+
+Usage:
+    python3 benchmarks/bench_timestamps.py
+    python3 benchmarks/bench_timestamps.py --count 200000
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import python_service  # noqa: E402
+
+
+def legacy_normalize_date_value(msg_date) -> str:
+    """normalize_date_value before TimestampParser, for comparison"""
+    if isinstance(msg_date, (int, float)):
+        if msg_date > 1e10:
+            return datetime.fromtimestamp(msg_date / 1000).isoformat()
+        return datetime.fromtimestamp(msg_date).isoformat()
+    if isinstance(msg_date, str):
+        if len(msg_date) > 19:
+            return msg_date
+        for fmt in ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']:
+            try:
+                return datetime.strptime(msg_date, fmt).isoformat()
+            except ValueError:
+                continue
+        return msg_date
+    return str(msg_date) if msg_date else datetime.now().isoformat()
+
+
+def samples(count: int) -> dict:
+    base = 1704067200  # 2024-01-01T00:00:00Z
+    stamps = [base + i * 37 for i in range(count)]
+    utc = [time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(s)) for s in stamps]
+    return {
+        'iso Z': [f'{u}Z' for u in utc],
+        'iso offset': [f'{u}.{i % 1000:03d}-05:00' for i, u in enumerate(utc)],
+        'naive': [u.replace('T', ' ') for u in utc],
+        'us format': [time.strftime('%m/%d/%Y %H:%M:%S', time.gmtime(s)) for s in stamps],
+        'epoch s': stamps,
+        'epoch ms': [s * 1000 + i % 1000 for i, s in enumerate(stamps)],
+    }
+
+
+def run(parse, values: list, repeat: int) -> float:
+    elapsed = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse(values)
+        elapsed = min(elapsed, time.perf_counter() - start)
+    return elapsed * 100000 / len(values) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3, help='report the best of N runs')
+    args = parser.parse_args()
+
+    print(f"{'ms per 100k':<12} {'legacy':>10} {'parse':>10} {'parse_many':>11}")
+    for label, values in samples(args.count).items():
+        timestamps = python_service.TimestampParser()
+        legacy = run(lambda vs: [legacy_normalize_date_value(v) for v in vs], values, args.repeat)
+        single = run(lambda vs: [timestamps.parse(v) for v in vs], values, args.repeat)
+        bulk = run(timestamps.parse_many, values, args.repeat)
+        assert timestamps.parse_many(values[:100]) == [timestamps.parse(v) for v in values[:100]]
+        print(f"{label:<12} {legacy:10.1f} {single:10.1f} {bulk:11.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""
+Local stand-in for the TextNow API, for benchmarks and offline testing
+
+Serves the endpoints python_service.py uses:
+    GET  /api/users/{username}/messages      all messages, or one conversation (contact_value)
+                                             paged with page_size / start_message_id / direction
+    POST /api/users/{username}/messages      send a text message
+    GET  /api/users/{username}               user info
+    GET  /api/v3/attachment_url              upload URL for media
+    PUT  /upload/{n}                         media upload
+    POST /api/v3/send_attachment             send uploaded media
+    GET  /media/{name}                       MMS media bytes (`size` query parameter, default 256 KiB)
+
+Latency, history size, message size, error rates (401/403/429/5xx) and a rate of
+new incoming messages are configurable.
+
+Usage:
+    python3 benchmarks/fake_textnow.py --port 8765 --messages 5000 --latency 20
+    TEXTNOW_BASE_URL=http://127.0.0.1:8765 python3 python_service.py serve
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+MESSAGES_RE = re.compile(r'^/api/users/([^/]+)/messages$')
+USER_RE = re.compile(r'^/api/users/([^/]+)$')
+
+
+def synthetic_messages(count: int, username: str = 'benchuser', contacts: int = 50, body_size: int = 40) -> list:
+    """Raw messages shaped like /api/users/{username}/messages entries, newest id last"""
+    messages = []
+    filler = 'x' * max(0, body_size - 20)
+    for i in range(count):
+        media = i % 10 == 0
+        number = f'+1212555{i % contacts:04d}'
+        messages.append({
+            'id': 9000000000 + i,
+            'username': username,
+            'contact_value': number,
+            'e164_contact_value': number,
+            'contact_type': 2,
+            'contact_name': f'Contact {i % contacts}',
+            'message_direction': 2 if i % 3 else 1,
+            'message_type': 2 if media else 1,
+            'message': f'https://media.example.com/{i}.jpg' if media else f'Message number {i} {filler}',
+            'read': bool(i % 2),
+            'date': f'2024-{1 + i % 12:02d}-{1 + i % 28:02d}T{i % 24:02d}:{i % 60:02d}:{(i * 7) % 60:02d}Z',
+            'conversation_filtering': {'first_time_contact': False, 'tags': []},
+        })
+    return messages
+
+
+class FakeTextNow:
+    """In-process fake TextNow server
+
+    `errors` maps a status code (401, 403, 429, 500, 503, ...) to the fraction
+    of requests that should fail with it. 429 responses carry Retry-After.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, messages: int = 1000, contacts: int = 50,
+                 body_size: int = 40, latency_ms: float = 0.0, jitter_ms: float = 0.0, errors: dict = None,
+                 retry_after: float = 1.0, seed: int = None):
+        self.history = synthetic_messages(messages, contacts=contacts, body_size=body_size)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.errors = errors or {}
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.counters = {}
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._next_id = 9000000000 + messages
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'FakeTextNow':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def count(self, route: str, nbytes: int = 0):
+        with self._lock:
+            self.counters[route] = self.counters.get(route, 0) + 1
+            self.bytes_sent += nbytes
+
+    # --- request handling ---
+
+    def injected_error(self):
+        """Status code to fail this request with, or None"""
+        roll = self.random.random()
+        for status, rate in self.errors.items():
+            if roll < rate:
+                return int(status)
+            roll -= rate
+        return None
+
+    def delay(self):
+        if self.latency_ms or self.jitter_ms:
+            time.sleep(max(0.0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000)
+
+    def page(self, params: dict) -> list:
+        """Messages for a GET /messages request, following the API's paging parameters"""
+        contact_value = params.get('contact_value')
+        direction = params.get('direction', 'past')
+        page_size = int(params.get('page_size', 30))
+        start_id = params.get('start_message_id')
+
+        history = self.history
+        if contact_value:
+            history = [m for m in history if m['contact_value'] == contact_value]
+        if direction == 'future':
+            selected = history if start_id is None else [m for m in history if m['id'] > int(start_id)]
+            return selected[:page_size]
+        # "past": newest first, before start_message_id
+        selected = history if start_id is None else [m for m in history if m['id'] < int(start_id)]
+        return list(reversed(selected[-page_size:])) if page_size else []
+
+    def send(self, number: str, text: str, direction: int = 1):
+        """Append a message to the history (direction 1: outgoing, 2: incoming)"""
+        with self._lock:
+            self._next_id += 1
+            message_id = self._next_id
+        self.history.append(dict(synthetic_messages(1)[0], id=message_id, contact_value=number,
+                                 e164_contact_value=number, message=text, message_direction=direction,
+                                 message_type=1, date=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())))
+
+    def receive(self, number: str, text: str):
+        self.send(number, text, direction=2)
+
+    def start_incoming(self, rate: float):
+        """Deliver `rate` incoming messages per second in the background"""
+        def deliver():
+            n = 0
+            while True:
+                time.sleep(1 / rate)
+                n += 1
+                self.receive(f'+1212555{n % 50:04d}', f'Incoming message {n}')
+        threading.Thread(target=deliver, daemon=True).start()
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+            disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status: int, body=None, route: str = 'other', headers: dict = None):
+                payload = json.dumps(body if body is not None else {}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+                fake.count(route, len(payload))
+
+            def reply_media(self, path: str, size: int):
+                """Deterministic bytes per path, so the same URL always has the same content"""
+                seed = hashlib.sha256(path.encode()).digest()
+                payload = (seed * (size // len(seed) + 1))[:size]
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(size))
+                self.end_headers()
+                self.wfile.write(payload)
+                fake.count('media', size)
+
+            def read_body(self) -> bytes:
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length) if length else b''
+
+            def handle_request(self, method: str):
+                url = urlparse(self.path)
+                params = dict(parse_qsl(url.query))
+                body = self.read_body() if method in ('POST', 'PUT') else b''
+                fake.delay()
+
+                status = fake.injected_error()
+                if status is not None:
+                    headers = {'Retry-After': str(fake.retry_after)} if status == 429 else None
+                    return self.reply(status, {'error': f'injected {status}'}, route=f'error_{status}', headers=headers)
+
+                if method == 'GET' and MESSAGES_RE.match(url.path):
+                    return self.reply(200, {'messages': fake.page(params)}, route='get_messages')
+                if method == 'POST' and MESSAGES_RE.match(url.path):
+                    form = dict(parse_qsl(body.decode()))
+                    data = json.loads(form.get('json', '{}'))
+                    fake.send(data.get('contact_value', ''), data.get('message', ''))
+                    return self.reply(200, {}, route='send_message')
+                if method == 'GET' and USER_RE.match(url.path):
+                    username = USER_RE.match(url.path).group(1)
+                    return self.reply(200, {'username': username, 'phone_number': '+12125550000'}, route='get_user')
+                if method == 'GET' and url.path == '/api/v3/attachment_url':
+                    upload = f"{fake.url}/upload/{fake.random.randrange(1 << 30)}"
+                    return self.reply(200, {'result': upload}, route='attachment_url')
+                if method == 'PUT' and url.path.startswith('/upload/'):
+                    return self.reply(200, {}, route='upload')
+                if method == 'POST' and url.path == '/api/v3/send_attachment':
+                    return self.reply(200, {}, route='send_attachment')
+                if method == 'GET' and url.path.startswith('/media/'):
+                    return self.reply_media(url.path, int(params.get('size', 256 * 1024)))
+                return self.reply(404, {'error': 'not found'})
+
+            def do_GET(self):
+                self.handle_request('GET')
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+            def do_PUT(self):
+                self.handle_request('PUT')
+
+        return Handler
+
+
+def parse_errors(args) -> dict:
+    errors = {}
+    for status, rate in ((401, args.rate_401), (403, args.rate_403), (429, args.rate_429), (503, args.rate_5xx)):
+        if rate:
+            errors[status] = rate
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--messages', type=int, default=1000, help='messages in the account history')
+    parser.add_argument('--contacts', type=int, default=50)
+    parser.add_argument('--body-size', type=int, default=40, help='approximate message text length')
+    parser.add_argument('--latency', type=float, default=0.0, help='added latency per request (ms)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='latency jitter (+/- ms)')
+    parser.add_argument('--rate-401', type=float, default=0.0)
+    parser.add_argument('--rate-403', type=float, default=0.0)
+    parser.add_argument('--rate-429', type=float, default=0.0)
+    parser.add_argument('--rate-5xx', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry-After seconds on 429')
+    parser.add_argument('--incoming-rate', type=float, default=0.0, help='new incoming messages per second')
+    args = parser.parse_args()
+
+    fake = FakeTextNow(host=args.host, port=args.port, messages=args.messages, contacts=args.contacts,
+                       body_size=args.body_size, latency_ms=args.latency, jitter_ms=args.jitter,
+                       errors=parse_errors(args), retry_after=args.retry_after)
+    if args.incoming_rate:
+        fake.start_incoming(args.incoming_rate)
+    print(f"Fake TextNow API on {fake.url} ({args.messages} messages)")
+    try:
+        fake.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
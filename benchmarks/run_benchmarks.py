@@ -0,0 +1,227 @@
+"""
+End-to-end benchmark suite for python_service.py, run against the local fake TextNow API
+
+Reports:
+    cold_start_ms          spawn-per-call `ping` round trip (interpreter + imports)
+    get_messages_msg_s     full-sync get_messages throughput through a serve worker
+    incremental_poll_ms    get_messages round trip when nothing is new
+    normalize_us_msg       MessageNormalizer cost per message
+    serialize_us_msg       JSON serialization cost per normalized message
+    send_msg_s             send_batch throughput (rate limiter disabled)
+
+Everything runs locally (no network access needed), so it can run in CI:
+
+    python3 benchmarks/run_benchmarks.py --quick --save bench.json
+    python3 benchmarks/run_benchmarks.py --quick --baseline bench.json --tolerance 0.3
+
+With --baseline the exit status is 1 when any metric is worse than the
+baseline by more than the tolerance (a fraction, default 0.25).
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE = os.path.join(BENCH_DIR, '..', 'python_service.py')
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+from fake_textnow import FakeTextNow, synthetic_messages  # noqa: E402
+
+USERNAME = 'benchuser'
+CREDENTIALS = {'username': USERNAME, 'sid_cookie': 'bench-sid', 'user_agent': 'bench'}
+
+# metric -> whether a higher value is better
+METRICS = {
+    'cold_start_ms': False,
+    'get_messages_msg_s': True,
+    'incremental_poll_ms': False,
+    'normalize_us_msg': False,
+    'serialize_us_msg': False,
+    'send_msg_s': True,
+}
+
+
+class Worker:
+    """A `python_service.py serve` process talking NDJSON over pipes"""
+
+    def __init__(self, env: dict):
+        self.process = subprocess.Popen([sys.executable, SERVICE, 'serve'], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+                                        bufsize=1, env=env)
+        self.next_id = 0
+
+    def call(self, command: str, **payload) -> dict:
+        """Send one request and return its final (non-streamed) response"""
+        self.next_id += 1
+        request = dict(CREDENTIALS, id=self.next_id, command=command, **payload)
+        self.process.stdin.write(json.dumps(request) + '\n')
+        self.process.stdin.flush()
+        response = json.loads(self.process.stdout.readline())
+        if 'error' in response:
+            raise RuntimeError(f"{command} failed: {response['error']}")
+        return response
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait(timeout=10)
+
+
+def service_env(base_url: str, data_dir: str) -> dict:
+    env = dict(os.environ)
+    env.update({
+        'TEXTNOW_BASE_URL': base_url,
+        'TEXTNOW_DATA_DIR': data_dir,
+        'TEXTNOW_SEND_RATE': '0',
+        'TEXTNOW_REQUEST_RATE': '0',
+        'TEXTNOW_MAX_PAGES': '100000',
+        'TEXTNOW_MESSAGES_CACHE_TTL': '0',  # measure polls, not the result cache
+    })
+    env.pop('TEXTNOW_DIAGNOSTICS', None)
+    return env
+
+
+def best(samples: list) -> float:
+    return min(samples)
+
+
+def bench_cold_start(env: dict, iterations: int) -> float:
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, SERVICE, 'ping'], input=b'{}', env=env,
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+
+def bench_get_messages(worker: Worker, history: int, iterations: int) -> float:
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        response = worker.call('get_messages', num_messages=history, full_sync=True)
+        samples.append(time.perf_counter() - start)
+        if len(response['messages']) != history:
+            raise RuntimeError(f"expected {history} messages, got {len(response['messages'])}")
+    return history / best(samples)
+
+
+def bench_incremental_poll(worker: Worker, iterations: int) -> float:
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        worker.call('get_messages', num_messages=50)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+
+def bench_normalize_serialize(count: int, iterations: int):
+    import python_service
+
+    raw = synthetic_messages(count, USERNAME)
+    normalize_samples, serialize_samples = [], []
+    for _ in range(iterations):
+        normalizer = python_service.MessageNormalizer(USERNAME)
+        start = time.perf_counter()
+        messages = [normalizer.normalize(m) for m in raw]
+        normalize_samples.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        json.dumps({'messages': messages}, ensure_ascii=False)
+        serialize_samples.append(time.perf_counter() - start)
+    return best(normalize_samples) / count * 1e6, best(serialize_samples) / count * 1e6
+
+
+def bench_send(worker: Worker, count: int, iterations: int) -> float:
+    recipients = [f'+1212555{i % 50:04d}' for i in range(count)]
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        response = worker.call('send_batch', recipients=recipients, message='benchmark', max_workers=8)
+        samples.append(time.perf_counter() - start)
+        if response['failed']:
+            raise RuntimeError(f"send_batch failed for {response['failed']} recipients")
+    return count / best(samples)
+
+
+def run_suite(args) -> dict:
+    fake = FakeTextNow(messages=args.messages, latency_ms=args.latency, seed=0).start()
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as data_dir:
+            env = service_env(fake.url, data_dir)
+            results['cold_start_ms'] = bench_cold_start(env, args.iterations)
+
+            worker = Worker(env)
+            try:
+                worker.call('ping')
+                results['get_messages_msg_s'] = bench_get_messages(worker, args.messages, args.iterations)
+                results['incremental_poll_ms'] = bench_incremental_poll(worker, args.iterations)
+                results['send_msg_s'] = bench_send(worker, args.sends, args.iterations)
+            finally:
+                worker.close()
+
+        results['normalize_us_msg'], results['serialize_us_msg'] = bench_normalize_serialize(
+            args.normalize_size, args.iterations)
+    finally:
+        fake.stop()
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Metrics worse than the baseline by more than `tolerance`"""
+    regressions = []
+    for name, higher_is_better in METRICS.items():
+        if name not in baseline or name not in results or not baseline[name]:
+            continue
+        change = (results[name] - baseline[name]) / baseline[name]
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append((name, baseline[name], results[name], change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='small sizes, for CI')
+    parser.add_argument('-n', '--iterations', type=int, default=5)
+    parser.add_argument('--messages', type=int, default=3000, help='history size for get_messages')
+    parser.add_argument('--sends', type=int, default=200, help='recipients per send_batch')
+    parser.add_argument('--normalize-size', type=int, default=100000)
+    parser.add_argument('--latency', type=float, default=0.0, help='fake API latency per request (ms)')
+    parser.add_argument('--save', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    if args.quick:
+        args.iterations = min(args.iterations, 3)
+        args.messages = min(args.messages, 600)
+        args.sends = min(args.sends, 50)
+        args.normalize_size = min(args.normalize_size, 10000)
+
+    results = run_suite(args)
+    for name, value in results.items():
+        print(f"{name:<22} {value:12,.2f}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, before, after, change in regressions:
+            print(f"REGRESSION {name}: {before:,.2f} -> {after:,.2f} ({change:+.0%})")
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions beyond {args.tolerance:.0%}")
+
+
+if __name__ == '__main__':
+    main()
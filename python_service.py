@@ -3,12 +3,22 @@ Python service for pythontextnow API integration
 This service can be called from Next.js API routes using child_process or HTTP requests
 """
 
+import hashlib
 import json
 import sys
 import os
+import random
 import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from typing import Dict, List, Any
 
+# Start of the import phase reported in request timings (see Timings)
+IMPORT_STARTED = time.perf_counter()
+
 # Disable color output and ensure clean stdout
 os.environ['NO_COLOR'] = '1'
 os.environ['PYTHONUNBUFFERED'] = '1'
@@ -26,23 +36,765 @@ if not sys.stdin.isatty():
     sys.stderr = DevNull()
 
 try:
-    from pythontextnow import Client, ConversationService
+    import mimetypes
+    import phonenumbers
     import requests
+    from requests.adapters import HTTPAdapter
+    from pythontextnow.enum import ContactType, MessageDirection, MessageType, ReadStatus
+    from pythontextnow.model.MultiMediaMessage import MultiMediaMessage
+    from pythontextnow.model.TextMessage import TextMessage
+    from pythontextnow.util.general import get_random_user_agent, replace_newlines
 except ImportError:
     error_msg = json.dumps({"error": "pythontextnow not installed. Run: pip install pythontextnow"})
     print(error_msg, file=sys.stderr)
     print(error_msg)
     sys.exit(1)
 
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
+
+# TextNow API location (overridable to point the service at a local stand-in)
+TEXTNOW_BASE_URL = os.environ.get('TEXTNOW_BASE_URL', 'https://www.textnow.com').rstrip('/')
+# The messages endpoint returns at most this many messages per page
+MAX_MESSAGE_PAGE_SIZE = 30
+# All-conversations paging: messages per request and a cap on requests per call
+PAGE_SIZE = int(os.environ.get('TEXTNOW_PAGE_SIZE', str(MAX_MESSAGE_PAGE_SIZE)))
+MAX_PAGES = int(os.environ.get('TEXTNOW_MAX_PAGES', '100'))
+
+
+# Per-account send rate: messages per second and burst size (0 disables the limit)
+SEND_RATE = float(os.environ.get('TEXTNOW_SEND_RATE', '1'))
+SEND_BURST = int(os.environ.get('TEXTNOW_SEND_BURST', '5'))
+
+
+class Timings:
+    """Per-request phase timings (monotonic) and counters
+
+    Phases accumulate, so e.g. every upstream request adds to "upstream".
+    Thread-safe: batch sends and page prefetching record from worker threads.
+    """
+
+    enabled = True
+
+    def __init__(self, report: bool = True):
+        self.report = report  # include in the response, not just the metrics
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add(self, phase: str, seconds: float):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def count(self, counter: str, n: int = 1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def phase(self, phase: str):
+        return _TimedPhase(self, phase)
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            phases = {name: round(seconds * 1000, 3) for name, seconds in self.phases.items()}
+            return {"phases_ms": phases, "counters": dict(self.counters)}
+
+    def snapshot(self):
+        """Copies of (phases, counters), safe to read while other threads still record"""
+        with self._lock:
+            return dict(self.phases), dict(self.counters)
+
+
+class _TimedPhase:
+    __slots__ = ("timings", "name", "started")
+
+    def __init__(self, timings: Timings, name: str):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings.add(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class NullTimings:
+    """Timings stand-in when instrumentation is off: every call is a no-op"""
+
+    enabled = False
+    report = False
+
+    def add(self, phase: str, seconds: float):
+        pass
+
+    def count(self, counter: str, n: int = 1):
+        pass
+
+    def phase(self, phase: str):
+        return _NULL_PHASE
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {}
+
+    def snapshot(self):
+        return {}, {}
+
+
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+NULL_TIMINGS = NullTimings()
+
+
+def label_value(value: str) -> str:
+    """Escape a Prometheus label value (backslash, double quote, newline)"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """Process-wide aggregate of request timings, rendered in Prometheus text format
+
+    Collected in serve mode when TEXTNOW_METRICS=1 or TEXTNOW_METRICS_FILE is
+    set; the file is rewritten at most every TEXTNOW_METRICS_INTERVAL seconds.
+    """
+
+    def __init__(self, path: str = None, interval: float = 5.0):
+        self.path = path
+        self.interval = interval
+        self.requests = {}  # (command, outcome) -> count
+        self.phase_sum = {}
+        self.phase_count = {}
+        self.counters = {}
+        self.started = time.time()
+        self._written = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, command: str, timings: Timings, error: bool = False):
+        # The command comes from the caller: only known ones get their own series
+        command = command if command in COMMANDS else "unknown"
+        # A prefetch thread may still be recording into `timings`
+        phases, counters = timings.snapshot()
+        with self._lock:
+            key = (command, "error" if error else "ok")
+            self.requests[key] = self.requests.get(key, 0) + 1
+            for phase, seconds in phases.items():
+                self.phase_sum[phase] = self.phase_sum.get(phase, 0.0) + seconds
+                self.phase_count[phase] = self.phase_count.get(phase, 0) + 1
+            for counter, n in counters.items():
+                self.counters[counter] = self.counters.get(counter, 0) + n
+        if self.path and time.monotonic() - self._written >= self.interval:
+            self.write()
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [
+                "# HELP textnow_requests_total Requests handled, by command and outcome",
+                "# TYPE textnow_requests_total counter",
+            ]
+            for (command, outcome), n in sorted(self.requests.items()):
+                lines.append(f'textnow_requests_total{{command="{label_value(command)}",outcome="{outcome}"}} {n}')
+            lines += [
+                "# HELP textnow_phase_seconds Time spent per request phase",
+                "# TYPE textnow_phase_seconds summary",
+            ]
+            for phase in sorted(self.phase_sum):
+                label = label_value(phase)
+                lines.append(f'textnow_phase_seconds_sum{{phase="{label}"}} {self.phase_sum[phase]:.6f}')
+                lines.append(f'textnow_phase_seconds_count{{phase="{label}"}} {self.phase_count[phase]}')
+            for counter in sorted(self.counters):
+                lines.append(f"# TYPE textnow_{counter}_total counter")
+                lines.append(f"textnow_{counter}_total {self.counters[counter]}")
+            lines += [
+                "# TYPE textnow_process_start_time_seconds gauge",
+                f"textnow_process_start_time_seconds {self.started:.3f}",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """Atomically replace the metrics file"""
+        self._written = time.monotonic()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, self.path)
+
+
+METRICS_FILE = os.environ.get('TEXTNOW_METRICS_FILE')
+metrics = Metrics(METRICS_FILE, interval=float(os.environ.get('TEXTNOW_METRICS_INTERVAL', '5')))
+METRICS_ENABLED = bool(METRICS_FILE) or os.environ.get('TEXTNOW_METRICS') == '1'
+
+
+def new_timings(input_data: Dict[str, Any], collect: bool = False):
+    """Timings for a request: reported with `timings: true`, or only collected for the metrics"""
+    if input_data.get("timings"):
+        return Timings()
+    if collect:
+        return Timings(report=False)
+    return NULL_TIMINGS
+
+
+class RateLimiter:
+    """Thread-safe token bucket: `rate` tokens per second, at most `burst` saved up
+
+    The rate adapts to throttling: throttle() halves it (down to 1/16 of the
+    configured rate) and recover() raises it back step by step. pause() holds
+    every caller until a given delay has passed, e.g. for a Retry-After.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self.rate <= 0:
+                    return
+                else:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def throttle(self):
+        with self._lock:
+            if self.max_rate > 0:
+                self.rate = max(self.max_rate / 16, self.rate / 2)
+
+    def recover(self):
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+# Statuses worth retrying; 401/403 (bad credentials) and other 4xx are permanent
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+# Methods that are safe to repeat after the request may have reached TextNow
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+MAX_RETRIES = int(os.environ.get('TEXTNOW_MAX_RETRIES', '3'))
+RETRY_BASE_DELAY = float(os.environ.get('TEXTNOW_RETRY_BASE_DELAY', '0.5'))
+RETRY_MAX_DELAY = float(os.environ.get('TEXTNOW_RETRY_MAX_DELAY', '30'))
+# Per-account budget for all upstream requests, sends included
+REQUEST_RATE = float(os.environ.get('TEXTNOW_REQUEST_RATE', '20'))
+REQUEST_BURST = int(os.environ.get('TEXTNOW_REQUEST_BURST', '40'))
+# Statuses meaning TextNow rejected the cookie
+AUTH_FAILURE_STATUSES = frozenset({401, 403})
+# How long a rejected cookie fails fast locally, and how long check_session trusts a good one
+AUTH_FAILURE_TTL = float(os.environ.get('TEXTNOW_AUTH_FAILURE_TTL', '600'))
+SESSION_CHECK_TTL = float(os.environ.get('TEXTNOW_SESSION_CHECK_TTL', '300'))
+
+
+def retry_after_seconds(response) -> float:
+    """Delay requested by a Retry-After header (seconds or HTTP date), or None"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class UpstreamError(Exception):
+    """Non-200 response from the TextNow API"""
+
+    def __init__(self, status_code: int):
+        super().__init__(f"API request failed with status {status_code}")
+        self.status_code = status_code
+
+
+class CredentialsRejected(UpstreamError):
+    """Request not sent: TextNow rejected this cookie recently (see CredentialHealth)"""
+
+    def __init__(self, status_code: int, rejected_at: float):
+        reason = "Forbidden" if status_code == 403 else "Unauthorized"
+        Exception.__init__(self, f"{status_code} {reason}: credentials were rejected "
+                                 f"{max(0, time.time() - rejected_at):.0f}s ago; update the cookie")
+        self.status_code = status_code
+        self.rejected_at = rejected_at
+
+
+class UpstreamScheduler:
+    """Admission and retries for one account's upstream requests
+
+    Every attempt takes a token from the account's request bucket (and from
+    `limiter`, e.g. the send bucket, when given). 429, 5xx and timeouts are
+    retried up to `max_retries` times with exponential backoff and full jitter,
+    or after the Retry-After delay, which also pauses the account's other
+    requests; a Retry-After longer than `max_delay` is not waited out, the
+    response is returned instead. A 429 halves the buckets' rates until
+    requests succeed again. Requests that are not idempotent (sends) are only
+    retried when TextNow cannot have processed them: 429, 503 and connection
+    timeouts.
+    """
+
+    def __init__(self, limiter: RateLimiter, max_retries: int = MAX_RETRIES,
+                 base_delay: float = RETRY_BASE_DELAY, max_delay: float = RETRY_MAX_DELAY):
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def run(self, method: str, send, limiter: RateLimiter = None) -> requests.Response:
+        """Call `send()` (one HTTP attempt) until it succeeds, fails permanently or runs out of retries"""
+        limiters = (self.limiter,) if limiter is None else (self.limiter, limiter)
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            for bucket in limiters:
+                bucket.acquire()
+            try:
+                response = send()
+            except requests.RequestException as e:
+                retryable = isinstance(e, requests.ConnectTimeout) or (
+                    idempotent and isinstance(e, (requests.ConnectionError, requests.Timeout)))
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+            else:
+                status = response.status_code
+                if status == 429:
+                    for bucket in limiters:
+                        bucket.throttle()
+                retryable = status in RETRYABLE_STATUSES and (idempotent or status in (429, 503))
+                retry_after = retry_after_seconds(response) if status in RETRYABLE_STATUSES else None
+                if retry_after is not None:
+                    # Honored in full, by the account's other requests too
+                    for bucket in limiters:
+                        bucket.pause(retry_after)
+                # A Retry-After beyond max_delay is not worth waiting for here: the caller gets the response
+                if not retryable or attempt >= self.max_retries or (retry_after or 0) > self.max_delay:
+                    if status < 400:
+                        for bucket in limiters:
+                            bucket.recover()
+                    return response
+                delay = retry_after if retry_after is not None else self.backoff(attempt)
+                response.close()
+            attempt += 1
+            time.sleep(delay)
+
+
+class AccountSession:
+    """Isolated HTTP session for one TextNow account
+
+    Replaces pythontextnow's process-global Client config: every account gets
+    its own requests.Session with a keep-alive connection pool and default
+    headers (cookie + exact browser user agent), so several accounts can be
+    served from one process without overwriting each other's credentials.
+    """
+
+    def __init__(self, username: str, sid_cookie: str, user_agent: str = None, pool_size: int = 10):
+        self.username = username
+        self.sid_cookie = sid_cookie
+        if not user_agent:
+            # Same fallback as pythontextnow: a stable user agent per username + cookie combo
+            seed = int(hashlib.sha256(f"{username}+{sid_cookie}".encode()).hexdigest(), 16)
+            user_agent = get_random_user_agent(seed)
+        self.user_agent = user_agent
+        self.pool_size = pool_size
+
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+        self.http.headers.update({
+            # According to GitHub issue #39, we need the EXACT user agent from the browser
+            'User-Agent': user_agent,
+            'Cookie': f'connect.sid={sid_cookie};',
+        })
+        # Shared by every send for this account, however many run concurrently
+        self.send_limiter = RateLimiter(SEND_RATE, SEND_BURST)
+        self.scheduler = UpstreamScheduler(RateLimiter(REQUEST_RATE, REQUEST_BURST))
+        self.last_used = time.monotonic()
+        # Auth verdicts are keyed by a hash of the cookie, never the cookie itself
+        self.cookie_hash = hashlib.sha256(f"{username}\0{sid_cookie}".encode()).hexdigest()[:32]
+        self.auth_failure = None  # (status, rejected_at) while TextNow rejects this cookie
+        health = get_credential_health()
+        verdict = health.get(username, self.cookie_hash) if health is not None else None
+        if verdict is not None and verdict[0] in AUTH_FAILURE_STATUSES:
+            self.auth_failure = verdict
+
+    def request(self, method: str, path: str, limiter: RateLimiter = None, fail_fast: bool = True,
+                **kwargs) -> requests.Response:
+        """Call the TextNow API; `path` is relative to TEXTNOW_BASE_URL unless absolute
+
+        Goes through the account's scheduler (rate limits and retries); `limiter`
+        is an extra bucket the request must also pass, such as send_limiter.
+        Raises CredentialsRejected without sending anything while the cookie
+        is known to be rejected (unless `fail_fast` is False).
+        """
+        self.last_used = time.monotonic()
+        # Absolute URLs (media storage) do not use the account cookie
+        textnow = not path.startswith('http')
+        if textnow and fail_fast:
+            self.ensure_credentials()
+        url = f"{TEXTNOW_BASE_URL}{path}" if textnow else path
+        kwargs.setdefault('timeout', 30)
+        body = kwargs.get('data')
+        # File bodies are rewound before every attempt
+        offset = body.tell() if hasattr(body, 'seek') else None
+
+        def send():
+            if offset is not None:
+                body.seek(offset)
+            return self.http.request(method, url, **kwargs)
+
+        response = self.scheduler.run(method, send, limiter)
+        if textnow:
+            self.record_status(response.status_code)
+        return response
+
+    def ensure_credentials(self):
+        """Raise CredentialsRejected if TextNow rejected this cookie less than AUTH_FAILURE_TTL ago"""
+        failure = self.auth_failure
+        if failure is not None:
+            if time.time() - failure[1] < AUTH_FAILURE_TTL:
+                raise CredentialsRejected(*failure)
+            self.auth_failure = None
+
+    def record_status(self, status: int, remember_ok: bool = False):
+        """Update the cookie's auth verdict from a TextNow response status
+
+        Successes are only written when they clear a failure or `remember_ok`
+        is set, so ordinary requests do not touch the database.
+        """
+        health = get_credential_health()
+        if status in AUTH_FAILURE_STATUSES:
+            self.auth_failure = (status, time.time())
+        elif status >= 400 or not (remember_ok or self.auth_failure is not None):
+            return
+        else:
+            self.auth_failure = None
+        if health is not None:
+            health.record(self.username, self.cookie_hash, status)
+
+    def check(self, force: bool = False):
+        """Validate the cookie with GET /api/users/{username}: (status, checked_at, cached)
+
+        Recent verdicts (from any process sharing the data directory) are
+        returned without a request unless `force` is set.
+        """
+        health = get_credential_health()
+        if not force and health is not None:
+            verdict = health.get(self.username, self.cookie_hash)
+            if verdict is not None:
+                return verdict[0], verdict[1], True
+        response = self.request('GET', f"/api/users/{self.username}", fail_fast=False)
+        response.close()
+        self.record_status(response.status_code, remember_ok=True)
+        return response.status_code, time.time(), False
+
+    def close(self):
+        self.http.close()
+
+    # --- TextNow endpoints (same requests pythontextnow's TextNowAPI makes) ---
+
+    def send_message(self, *, message: str, send_to: str) -> None:
+        json_data = {
+            "contact_value": send_to,
+            "contact_type": ContactType.DEFAULT.value,
+            "message": replace_newlines(message),
+            "read": ReadStatus.READ.value,
+            "message_direction": MessageDirection.OUTGOING.value,
+            "message_type": MessageType.TEXT.value,
+            "from_name": self.username,
+            "has_video": False,
+            "new": True,
+            "date": datetime.now().isoformat(),
+        }
+        response = self.request('POST', f"/api/users/{self.username}/messages",
+                                data={"json": json.dumps(json_data)}, limiter=self.send_limiter)
+        response.raise_for_status()
+
+    def get_conversation_messages(self, phone_number: str, *, start_message_id: str = None,
+                                  page_size: int = MAX_MESSAGE_PAGE_SIZE, get_archived: bool = True) -> list:
+        """One page of messages (most recent first) before `start_message_id`"""
+        contact_value = phone_number if phone_number.startswith('+') else f"+{phone_number}"
+        params = {
+            "contact_value": contact_value,
+            "direction": "past",
+            "page_size": min(page_size, MAX_MESSAGE_PAGE_SIZE),
+            "get_archived": 1 if get_archived else 0,
+        }
+        if start_message_id is not None:
+            params["start_message_id"] = start_message_id
+        response = self.request('GET', f"/api/users/{self.username}/messages", params=params)
+        response.raise_for_status()
+
+        messages = []
+        for message_dict in response.json()["messages"]:
+            message_type = MessageType.from_value(message_dict["message_type"])
+            if message_type == MessageType.TEXT:
+                messages.append(TextMessage.from_dict(message_dict))
+            elif message_type in (MessageType.IMAGE, MessageType.VIDEO):
+                messages.append(MultiMediaMessage.from_dict(message_dict))
+        return messages
+
+    def get_attachment_url(self, *, message_type: MessageType) -> str:
+        """URL that a media file can be uploaded to"""
+        response = self.request('GET', "/api/v3/attachment_url", params={"message_type": message_type.value})
+        response.raise_for_status()
+        return response.json()["result"]
+
+    def upload_raw_media(self, *, attachment_url: str, raw_media, media_type: str) -> None:
+        # The upload goes to storage, not TextNow, so it must not carry the account cookie
+        response = self.request('PUT', attachment_url, data=raw_media, timeout=60, headers={
+            "accept": "*/*",
+            "content-type": media_type,
+            "accept-language": "en-US,en;q=0.9",
+            "Cookie": None,
+        })
+        response.raise_for_status()
+
+    def send_attachment(self, *, conversation_phone_number: str, message_type: MessageType,
+                        file_type: str, is_video: bool, attachment_url: str) -> None:
+        data = {
+            "contact_value": conversation_phone_number,
+            "contact_type": ContactType.ALTERNATE.value,
+            "read": 1,
+            "message_direction": MessageDirection.OUTGOING.value,
+            "message_type": message_type.value,
+            "from_name": self.username,
+            "has_video": is_video,
+            "new": True,
+            "date": datetime.now().isoformat(),
+            "attachment_url": attachment_url,
+            "media_type": file_type,
+        }
+        response = self.request('POST', "/api/v3/send_attachment", data=data, limiter=self.send_limiter)
+        response.raise_for_status()
+
+
+class SessionRegistry:
+    """Per-account AccountSession cache with LRU and idle-TTL eviction
+
+    Keyed by (username, sid_cookie, user_agent): a new cookie or user agent
+    gets a fresh session, and the old one ages out.
+    """
+
+    def __init__(self, max_sessions: int = 64, idle_ttl: float = 900.0):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username: str, sid_cookie: str, user_agent: str = None) -> AccountSession:
+        key = (username, sid_cookie, user_agent)
+        evicted = []
+        with self._lock:
+            now = time.monotonic()
+            # Drop sessions that have been idle too long (oldest first)
+            while self._sessions:
+                oldest_key, oldest = next(iter(self._sessions.items()))
+                if now - oldest.last_used <= self.idle_ttl:
+                    break
+                evicted.append(self._sessions.pop(oldest_key))
+
+            session = self._sessions.get(key)
+            if session is None:
+                session = AccountSession(username, sid_cookie, user_agent)
+                self._sessions[key] = session
+                while len(self._sessions) > self.max_sessions:
+                    evicted.append(self._sessions.popitem(last=False)[1])
+            else:
+                self._sessions.move_to_end(key)
+            session.last_used = now
+
+        for old in evicted:
+            old.close()
+        return session
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+session_registry = SessionRegistry(
+    max_sessions=int(os.environ.get('TEXTNOW_MAX_SESSIONS', '64')),
+    idle_ttl=float(os.environ.get('TEXTNOW_SESSION_IDLE_TTL', '900')),
+)
+
+
+def validate_phone_number(phone_number: str) -> str:
+    """Check the number is a valid E.164 number (same check pythontextnow does)"""
+    parsed_number = phonenumbers.parse(phone_number)
+    if not phonenumbers.is_valid_number(parsed_number):
+        raise ValueError(f"'{phone_number}' is not a possible phone number.")
+    return phone_number
+
+
+def media_error_result(error: Exception) -> Dict[str, Any]:
+    """send_media failure result with helpful 401/403 messages"""
+    error_msg = str(error)
+    error_lower = error_msg.lower()
+
+    # Provide helpful error messages
+    if "403" in error_msg or "forbidden" in error_lower:
+        return {
+            "success": False, 
+            "error": "403 Forbidden: Your SID cookie may be invalid or expired. Get a fresh cookie from TextNow.com and update your settings."
+        }
+    elif "401" in error_msg or "unauthorized" in error_lower:
+        return {
+            "success": False,
+            "error": "401 Unauthorized: Please check your TextNow username and SID cookie are correct."
+        }
+    return {"success": False, "error": error_msg}
+
+
+def hash_file(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """SHA-256 of a file, read in chunks so large videos are never fully in memory"""
+    digest = hashlib.sha256()
+    with open(file_path, mode="rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class TTLCache:
+    """LRU cache whose entries expire `ttl` seconds after they are stored (a ttl of 0 disables it)"""
+
+    def __init__(self, ttl: float, max_entries: int = 256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, match):
+        """Drop every entry whose key satisfies `match(key)`"""
+        with self._lock:
+            for key in [key for key in self._entries if match(key)]:
+                del self._entries[key]
+
+
+class MediaUploadCache(TTLCache):
+    """Uploaded media by (account, content hash), each entry kept for `ttl` seconds"""
+
+    LOCK_STRIPES = 64
+
+    def __init__(self, ttl: float = 3600.0, max_entries: int = 256):
+        super().__init__(ttl, max_entries)
+        # A fixed pool of locks picked by key hash: bounded no matter how many
+        # files are uploaded, and nothing to clean up on expiry or failure
+        self._locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+
+    def lock(self, key) -> threading.Lock:
+        """Lock for `key` so only one upload of the same content runs at a time"""
+        return self._locks[hash(key) % len(self._locks)]
+
+
+class SingleFlight:
+    """Coalesce concurrent calls: one call per key runs, concurrent callers share its outcome"""
+
+    class _Call:
+        __slots__ = ("done", "result", "error")
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Return (fn() result, shared), where shared is True when another caller's run was reused"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+media_upload_cache = MediaUploadCache(ttl=float(os.environ.get('TEXTNOW_MEDIA_CACHE_TTL', '3600')))
+
+# get_messages results by (account, cookie hash, phone number, num_messages, paging), served for a short
+# window, and the in-flight fetches that concurrent identical calls wait on
+messages_cache = TTLCache(ttl=float(os.environ.get('TEXTNOW_MESSAGES_CACHE_TTL', '2')))
+messages_flight = SingleFlight()
+
 
 class TextNowService:
-    def __init__(self, username: str, sid_cookie: str, user_agent: str = None):
+    def __init__(self, username: str, sid_cookie: str, user_agent: str = None, timings=NULL_TIMINGS):
         """Initialize TextNow client
         
         Args:
             username: TextNow username
             sid_cookie: connect.sid cookie value
             user_agent: User agent string from browser (required per GitHub issue #39)
+            timings: Timings recorder for this request (no-op by default)
         """
         try:
             # Clean the SID cookie - it might have extra formatting
@@ -63,33 +815,50 @@ class TextNowService:
                 # If it doesn't start correctly, it might be malformed
                 pass  # Let the library handle validation
             
-            # According to GitHub issue #39, we need the EXACT user agent from the browser
-            # Patch the requests session to use the exact user agent
-            if user_agent:
-                # Monkey-patch the default headers for requests
-                # This ensures all requests use the exact user agent from the browser
-                original_request = requests.Session.request
-                def patched_request(self, method, url, **kwargs):
-                    if 'headers' not in kwargs:
-                        kwargs['headers'] = {}
-                    if 'User-Agent' not in kwargs['headers']:
-                        kwargs['headers']['User-Agent'] = user_agent
-                    return original_request(self, method, url, **kwargs)
-                requests.Session.request = patched_request
-            
-            Client.set_client_config(username=username, sid_cookie=clean_sid)
             self.username = username
             self.sid_cookie = clean_sid
             self.user_agent = user_agent
+            self.timings = timings
+            self.session = session_registry.get(username, clean_sid, user_agent)
         except Exception as e:
             raise Exception(f"Failed to initialize TextNow client: {str(e)}")
 
+    def _upstream(self, call, *args, **kwargs):
+        """Run one upstream API call, timed under the "upstream" phase"""
+        self.timings.count("upstream_requests")
+        with self.timings.phase("upstream"):
+            return call(*args, **kwargs)
+
+    def check_session(self, force: bool = False) -> Dict[str, Any]:
+        """Check the credentials with one cheap request, reusing a recent verdict unless `force`"""
+        try:
+            status, checked_at, cached = self.session.check(force)
+        except Exception as e:
+            return {"valid": False, "error": f"Session check failed: {str(e)}"}
+        if not cached:
+            self.timings.count("upstream_requests")
+        result = {
+            "valid": status < 400,
+            "status": status,
+            "checked_at": format_utc(datetime.fromtimestamp(checked_at, timezone.utc)),
+            "cached": cached,
+        }
+        if status == 403:
+            result["error"] = "403 Forbidden: Cookie expired or invalid"
+        elif status == 401:
+            result["error"] = "401 Unauthorized: Invalid credentials"
+        elif status >= 400:
+            result["error"] = f"API request failed with status {status}"
+        return result
+
     def send_sms(self, phone_number: str, message: str) -> Dict[str, Any]:
         """Send an SMS message"""
         try:
             # Phone number must be in E.164 format
-            conversation_service = ConversationService(conversation_phone_numbers=[phone_number])
-            conversation_service.send_message(message=message)
+            validate_phone_number(phone_number)
+            self._upstream(self.session.send_message, message=message, send_to=phone_number)
+            # The conversation changed: drop this account's cached get_messages results
+            messages_cache.discard(lambda key: key[0] == self.username)
             return {"success": True, "message": "Message sent successfully"}
         except Exception as e:
             error_msg = str(e)
@@ -108,50 +877,285 @@ class TextNowService:
                 }
             return {"success": False, "error": error_msg}
 
-    def send_media(self, phone_number: str, file_path: str) -> Dict[str, Any]:
-        """Send media (image, video, GIF) only. Message should be sent separately."""
+    def iter_send_batch(self, recipients: List[Dict[str, str]], max_workers: int = 4):
+        """Send to many recipients over a bounded thread pool sharing this account's session
+
+        Each recipient is {"number": ..., "message": ...}. Yields one result per
+        recipient as it completes: send_sms's result (same 401/403 error
+        classification) plus the recipient's "number" and "index". The
+        account's send rate limit applies across all workers.
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            futures = {
+                pool.submit(self.send_sms, recipient["number"], recipient["message"]): index
+                for index, recipient in enumerate(recipients)
+            }
+            for future in as_completed(futures):
+                index = futures[future]
+                yield dict(future.result(), number=recipients[index]["number"], index=index)
+
+    def iter_conversations(self, phone_numbers: List[str], num_messages: int = 50, max_workers: int = 8):
+        """Fetch several conversations concurrently over this account's session
+
+        Yields {"number", "messages"} per number as it completes, plus "error"
+        when the fetch failed (possibly after returning some messages). Each
+        fetch goes through get_messages, so identical concurrent requests are
+        coalesced and the account's request rate limit applies across workers.
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        # Beyond the session's connection pool, extra workers would only wait for a connection
+        workers = max(1, min(max_workers, self.session.pool_size, len(phone_numbers) or 1))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(self.get_messages, number, num_messages): number for number in phone_numbers}
+            for future in as_completed(futures):
+                number = futures[future]
+                try:
+                    records = future.result()
+                except Exception as e:
+                    records = [{"error": str(e)}]
+                conversation = {"number": number, "messages": [r for r in records if "error" not in r]}
+                errors = [r["error"] for r in records if "error" in r]
+                if errors:
+                    conversation["error"] = errors[0]
+                yield conversation
+
+    def upload_media(self, file_path: str) -> Dict[str, Any]:
+        """Upload a media file once per content hash and return what send_attachment needs
+
+        The file is hashed with a streaming read, and the attachment URL is
+        cached per (account, content hash) for TEXTNOW_MEDIA_CACHE_TTL seconds,
+        so sending the same file again skips the upload. Concurrent uploads of
+        the same content wait for the first one instead of uploading twice.
+        """
+        media_type = mimetypes.guess_type(file_path)[0]
+        if media_type is None:
+            raise ValueError("Cannot get media type from media at 'file_path'.")
+        file_type = media_type.split("/")[0]  # "image" or "video"
+        if file_type == "audio":
+            raise ValueError(f"'{file_type}' is not an allowed media type.")
+        is_video = file_type == "video"
+        message_type = MessageType.VIDEO if is_video else MessageType.IMAGE
+
+        key = (self.username, hash_file(file_path))
+        with media_upload_cache.lock(key):
+            media = media_upload_cache.get(key)
+            if media is None:
+                attachment_url = self._upstream(self.session.get_attachment_url, message_type=message_type)
+                # Stream the file from disk instead of reading it into memory
+                with open(file_path, mode="rb") as raw_media:
+                    self._upstream(self.session.upload_raw_media, attachment_url=attachment_url, raw_media=raw_media,
+                                   media_type=media_type)
+                media = {
+                    "attachment_url": attachment_url,
+                    "message_type": message_type,
+                    "file_type": file_type,
+                    "is_video": is_video,
+                }
+                media_upload_cache.put(key, media)
+        return media
+
+    def send_media(self, phone_number: str, file_path: str, media: Dict[str, Any] = None) -> Dict[str, Any]:
+        """Send media (image, video, GIF) only. Message should be sent separately.
+
+        `media` is an upload_media() result to reuse; by default the file is
+        uploaded (or found in the upload cache) first.
+        """
         try:
             # Verify file exists
             if not os.path.exists(file_path):
                 return {"success": False, "error": f"File not found: {file_path}"}
             
-            conversation_service = ConversationService(conversation_phone_numbers=[phone_number])
-            # Send the media
-            conversation_service.send_media(file_path=file_path)
+            validate_phone_number(phone_number)
+            if media is None:
+                media = self.upload_media(file_path)
+
+            # Send the uploaded file to the conversation
+            self._upstream(self.session.send_attachment, conversation_phone_number=phone_number, **media)
             
+            # The conversation changed: drop this account's cached get_messages results
+            messages_cache.discard(lambda key: key[0] == self.username)
             return {"success": True, "message": "Media sent successfully"}
         except Exception as e:
-            error_msg = str(e)
-            error_lower = error_msg.lower()
-            
-            # Provide helpful error messages
-            if "403" in error_msg or "forbidden" in error_lower:
-                return {
-                    "success": False, 
-                    "error": "403 Forbidden: Your SID cookie may be invalid or expired. Get a fresh cookie from TextNow.com and update your settings."
-                }
-            elif "401" in error_msg or "unauthorized" in error_lower:
-                return {
-                    "success": False,
-                    "error": "401 Unauthorized: Please check your TextNow username and SID cookie are correct."
-                }
-            return {"success": False, "error": error_msg}
+            return media_error_result(e)
+
+    def iter_send_media_batch(self, phone_numbers: List[str], file_path: str, max_workers: int = 4):
+        """Send one media file to many recipients: upload once, then fan out the sends
+
+        Yields one send_media result per recipient as it completes, plus the
+        recipient's "number" and "index".
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        media = None
+        error = None
+        if not os.path.exists(file_path):
+            error = {"success": False, "error": f"File not found: {file_path}"}
+        else:
+            try:
+                media = self.upload_media(file_path)
+            except Exception as e:
+                error = media_error_result(e)
+        if error is not None:
+            for index, number in enumerate(phone_numbers):
+                yield dict(error, number=number, index=index)
+            return
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            futures = {
+                pool.submit(self.send_media, number, file_path, media): index
+                for index, number in enumerate(phone_numbers)
+            }
+            for future in as_completed(futures):
+                index = futures[future]
+                yield dict(future.result(), number=phone_numbers[index], index=index)
 
-    def get_messages(self, phone_number: str = None, num_messages: int = 50) -> List[Dict[str, Any]]:
-        """Get messages from a conversation"""
+    def _iter_conversation_pages(self, phone_number: str, num_messages: int = None):
+        """Yield pages of Message objects (most recent first) until num_messages are fetched"""
+        start_message_id = None
+        fetched = 0
+        while num_messages is None or fetched < num_messages:
+            page_size = MAX_MESSAGE_PAGE_SIZE if num_messages is None else min(MAX_MESSAGE_PAGE_SIZE, num_messages - fetched)
+            messages = self._upstream(
+                self.session.get_conversation_messages,
+                phone_number, start_message_id=start_message_id, page_size=page_size
+            )
+            if not messages:
+                return
+            start_message_id = messages[-1].id_
+            fetched += len(messages)
+            yield messages
+
+    def fetch_media(self, url: str) -> Dict[str, Any]:
+        """Download MMS media into the local media cache and describe the cached file
+
+        Only media of the account's stored messages, or URLs on TextNow's own
+        hosts (see media_host_allowed), are fetched, and never API paths;
+        anything else is refused before any request. Repeat fetches of a URL by
+        the same account are served from disk once its credentials are known to
+        be valid; concurrent fetches of the same URL share one download. Returns
+        {"path", "size", "content_type", "sha256", "cached"}, plus "local_url"
+        when the serve-mode media endpoint is running.
+        """
+        try:
+            if not url.startswith(('http://', 'https://')):
+                raise ValueError(f"Not a media URL: {url}")
+            store = get_message_store()
+            if not media_path_allowed(url) or not (
+                    media_host_allowed(url) or (store is not None and store.has_media_url(self.username, url))):
+                raise ValueError("URL is not a media URL of this account's messages")
+            cache = get_media_cache()
+            entry = cache.lookup(self.username, url)
+            cached = entry is not None
+            if cached:
+                # No upstream request on a hit, so check the cookie (a recent verdict is reused)
+                session = self.check_session()
+                if not session["valid"]:
+                    raise ValueError(session["error"])
+            else:
+                entry, cached = media_flight.do((self.username, url), lambda: self._download_media(url, cache))
+        except Exception as e:
+            return {"error": f"Failed to fetch media: {str(e)}"}
+        result = dict(entry, cached=cached)
+        if media_server is not None:
+            result["local_url"] = media_server.url_for(entry["sha256"])
+        return result
+
+    def _download_media(self, url: str, cache: 'MediaCache') -> Dict[str, Any]:
+        """Stream `url` into `cache` (runs once per URL at a time, see media_flight)
+
+        Redirects are followed by hand, and only to URLs media_host_allowed and
+        media_path_allowed accept.
+        """
+        from urllib.parse import urljoin, urlparse
+
+        location = url
+        for redirects in range(MEDIA_MAX_REDIRECTS + 1):
+            host = (urlparse(location).hostname or '').lower()
+            # The account cookie only goes to TextNow's own hosts
+            headers = {} if host_within(host, textnow_host()) else {"Cookie": None}
+            response = self._upstream(self.session.request, 'GET', location, stream=True, timeout=60,
+                                      headers=headers, allow_redirects=False)
+            if not response.is_redirect:
+                break
+            response.close()
+            location = urljoin(location, response.headers['Location'])
+            if redirects == MEDIA_MAX_REDIRECTS or not (media_host_allowed(location) and
+                                                        media_path_allowed(location)):
+                raise ValueError(f"Refusing media redirect to {location}")
+        with response:
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip() or None
+            entry = cache.store(self.username, url, response.iter_content(MEDIA_CHUNK_SIZE), content_type)
+        self.timings.count("bytes_received", entry["size"])
+        return entry
+
+    def get_messages(self, phone_number: str = None, num_messages: int = 50, full_sync: bool = False,
+                     page_size: int = None, max_pages: int = None,
+                     diagnostics: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        """Get messages from a conversation, or received messages from all conversations
+
+        Without a phone number, only messages newer than the local store's sync
+        cursor are fetched; `full_sync` re-downloads the whole history. That path
+        is paginated: `page_size` messages per request, at most `max_pages` requests.
+        When a `diagnostics` dict is given (see new_diagnostics), it is filled in
+        with details about the upstream response.
+
+        Identical concurrent calls for the same account and cookie share one upstream fetch,
+        and successful results are reused for TEXTNOW_MESSAGES_CACHE_TTL seconds
+        (default 2). Full syncs and diagnostic calls always fetch.
+        """
+        def fetch():
+            return list(self.iter_messages(phone_number, num_messages, full_sync=full_sync, page_size=page_size,
+                                           max_pages=max_pages, diagnostics=diagnostics))
+
+        if full_sync or diagnostics is not None:
+            return fetch()
+
+        # The cookie is part of the key: a cached result is only served to the credentials that fetched it
+        key = (self.username, self.session.cookie_hash, phone_number or None, num_messages, page_size, max_pages)
+        messages = messages_cache.get(key)
+        if messages is not None:
+            self.timings.count("cache_hits")
+            return messages
+
+        def fetch_and_cache():
+            # A caller that just missed the previous flight finds its result here
+            cached = messages_cache.get(key)
+            if cached is not None:
+                return cached
+            result = fetch()
+            if not any("error" in message for message in result):
+                messages_cache.put(key, result)
+            return result
+
+        messages, shared = messages_flight.do(key, fetch_and_cache)
+        if shared:
+            self.timings.count("coalesced")
+        return messages
+
+    def iter_messages(self, phone_number: str = None, num_messages: int = 50, full_sync: bool = False,
+                      page_size: int = None, max_pages: int = None, diagnostics: Dict[str, Any] = None):
+        """Generator version of get_messages: yields normalized messages as they are produced
+
+        Errors are yielded as {"error": ...} records.
+        """
         try:
-            result = []
-            
             if phone_number:
                 # Get messages from specific conversation
                 # Phone number must be in E.164 format
-                conversation_service = ConversationService(conversation_phone_numbers=[phone_number])
-                messages_generator = conversation_service.get_messages(num_messages=num_messages)
+                validate_phone_number(phone_number)
                 
-                for message_list in messages_generator:
+                timings = self.timings
+                timestamps = TimestampParser()
+                for message_list in self._iter_conversation_pages(phone_number, num_messages):
                     if not message_list:
                         continue
+                    timings.count("messages_parsed", len(message_list))
                     for msg in message_list:
+                        started = time.perf_counter() if timings.enabled else 0.0
                         try:
                             # Use pythontextnow Message object attributes correctly
                             # According to GitHub: message.from_, message.to, message.date, message.content
@@ -160,25 +1164,9 @@ class TextNowService:
                             # Get content - the library uses 'content' attribute
                             msg_content = getattr(msg, 'content', None) or ''
                             
-                            # Get date - the library returns datetime objects
-                            from datetime import datetime
-                            msg_date = getattr(msg, 'date', None)
-                            if msg_date:
-                                if hasattr(msg_date, 'isoformat'):
-                                    msg_date = msg_date.isoformat()
-                                elif hasattr(msg_date, 'strftime'):
-                                    msg_date = msg_date.strftime('%Y-%m-%dT%H:%M:%S')
-                                elif isinstance(msg_date, (int, float)):
-                                    # Handle timestamp
-                                    if msg_date > 1e10:
-                                        msg_date = datetime.fromtimestamp(msg_date / 1000).isoformat()
-                                    else:
-                                        msg_date = datetime.fromtimestamp(msg_date).isoformat()
-                                else:
-                                    msg_date = str(msg_date)
-                            else:
-                                # Use current time as fallback to avoid invalid dates
-                                msg_date = datetime.now().isoformat()
+                            # Get date - the library returns datetime objects; missing dates
+                            # fall back to the current time to avoid invalid dates
+                            msg_date = timestamps.parse(getattr(msg, 'date', None))
                             
                             # Get from/to - the library uses 'from_' (with underscore) and 'to'
                             msg_from = getattr(msg, 'from_', None) or getattr(msg, 'from', None) or ''
@@ -234,318 +1222,2493 @@ class TextNowService:
                                 msg_data["media_url"] = str(msg.media_url)
                             elif hasattr(msg, 'media') and msg.media:
                                 msg_data["media_url"] = str(msg.media)
-                                
-                            result.append(msg_data)
+
+                            if started:
+                                timings.add("normalize", time.perf_counter() - started)
+                            yield msg_data
                         except Exception as e:
                             # Skip individual message errors but continue processing
-                            import traceback
-                            # Log the error for debugging
+                            timings.count("messages_skipped")
                             continue
             else:
                 # Get all messages from all conversations
-                # According to GitHub, we need to get conversations first, then get messages from each
-                # But the library might not have a direct way to get all conversations
-                # So we'll use the direct API call but parse it using the library's Message structure if possible
-                try:
-                    # Get client config to access the API
-                    client_config = Client.get_client_config()
-                    username = client_config.get('username')
-                    sid_cookie = client_config.get('sid_cookie')
-                    
-                    if not username or not sid_cookie:
-                        return []
-                    
-                    # Make direct API call to TextNow to get all messages
-                    # TextNow API endpoint: https://www.textnow.com/api/users/{username}/messages
-                    api_url = f"https://www.textnow.com/api/users/{username}/messages"
-                    
-                    # Prepare headers with user agent
-                    headers = {
-                        'Cookie': f'connect.sid={sid_cookie}',
-                        'Content-Type': 'application/json',
-                    }
-                    if self.user_agent:
-                        headers['User-Agent'] = self.user_agent
-                    
-                    # Make request to get all messages
-                    response = requests.get(api_url, headers=headers, timeout=30)
-                    
-                    if response.status_code == 200:
-                        data = response.json()
-                        messages_data = data.get('messages', []) or data.get('data', []) or []
-                        
-                        # DEBUG: Output FULL first message structure to help diagnose parsing issues
-                        # This will be included in the JSON output so we can see it
-                        debug_info = {
-                            "debug_total_messages": len(messages_data),
-                            "debug_response_keys": list(data.keys()) if isinstance(data, dict) else [],
-                            "debug_response_structure": str(type(data))
-                        }
-                        if messages_data and len(messages_data) > 0:
-                            first_msg = messages_data[0]
-                            if isinstance(first_msg, dict):
-                                # Output the FULL first message (all fields) so we can see the exact structure
-                                import json as json_module
-                                debug_info.update({
-                                    "debug_first_message_keys": list(first_msg.keys()),
-                                    "debug_first_message_full": json_module.dumps(first_msg, default=str, indent=2),  # Full message as JSON string
-                                    "debug_all_message_keys": set()  # Collect all unique keys from all messages
-                                })
-                                # Collect all unique keys from first 5 messages
-                                for msg in messages_data[:5]:
-                                    if isinstance(msg, dict):
-                                        debug_info["debug_all_message_keys"].update(msg.keys())
-                                debug_info["debug_all_message_keys"] = list(debug_info["debug_all_message_keys"])
+                yield from self._iter_all_messages(num_messages, full_sync=full_sync, page_size=page_size,
+                                                   max_pages=max_pages, diagnostics=diagnostics)
+        except Exception as e:
+            yield {"error": str(e)}
+
+    def _iter_all_messages(self, num_messages: int = None, full_sync: bool = False, page_size: int = None,
+                           max_pages: int = None, diagnostics: Dict[str, Any] = None):
+        """Received messages from all conversations, synced through the local message store
+
+        The store keeps every normalized message plus a per-account cursor (newest
+        upstream message id/date). Only messages after the cursor are requested
+        and normalized; the rest is served from disk. Saving is an upsert by
+        message id, so an upstream that ignores the cursor costs bandwidth but
+        never produces duplicates.
+
+        The upstream is read page by page (see _iter_message_pages), so memory is
+        bounded by the page size. At most `num_messages` messages are returned;
+        without the store, fetching also stops once that many are found.
+        """
+        new_messages = []
+        try:
+            username = self.username
+            store = get_message_store()
+            cursor = store.get_cursor(username) if store is not None and not full_sync else None
+            incremental = bool(cursor and cursor.get("last_message_id"))
+
+            # Newer than the cursor when syncing incrementally, otherwise back from the newest message
+            pages = self._iter_message_pages(
+                direction="future" if incremental else "past",
+                start_message_id=cursor["last_message_id"] if incremental else None,
+                page_size=page_size or PAGE_SIZE,
+                max_pages=max_pages or MAX_PAGES,
+            )
+
+            # Process messages - focus on received messages
+            normalizer = MessageNormalizer(username)
+            timed = self.timings.enabled
+            normalize_seconds = 0.0
+            parsed = skipped = 0
+            last_message_id = cursor.get("last_message_id") if cursor else None
+            last_date = cursor.get("last_date") if cursor else None
+            yielded = 0
+            page_count = 0
+            for data, messages_data in pages:
+                page_count += 1
+                if diagnostics is not None and page_count == 1:
+                    describe_response(diagnostics, data, messages_data, incremental=incremental)
+
+                parsed += len(messages_data)
+                for msg_data in messages_data:
+                    try:
+                        # Advance the cursor over every upstream message, sent ones included
+                        upstream_id = msg_data.get('id')
+                        if upstream_id is not None and is_newer_message_id(upstream_id, last_message_id):
+                            last_message_id = str(upstream_id)
+                            last_date = msg_data.get('date') or last_date
+
+                        if timed:
+                            started = time.perf_counter()
+                            msg_result = normalizer.normalize(msg_data)
+                            normalize_seconds += time.perf_counter() - started
                         else:
-                            # Even if no messages, include info about the response
-                            import json as json_module
-                            debug_info["debug_no_messages"] = True
-                            debug_info["debug_full_response"] = json_module.dumps(data, default=str, indent=2)[:1000]  # First 1000 chars
-                        
-                        # Process messages - focus on received messages
-                        for msg_data in messages_data:
-                            try:
-                                # Extract message information
-                                msg_id = msg_data.get('id') or msg_data.get('message_id') or msg_data.get('_id')
-                                msg_content = msg_data.get('content') or msg_data.get('message') or msg_data.get('text') or msg_data.get('body') or ''
-                                
-                                # Extract phone number - for received messages, it's usually in 'contact_value', 'from', or 'contact_number'
-                                # TextNow API structure varies, so check multiple fields
-                                # Try to get phone number from nested contact object first
-                                contact_obj = msg_data.get('contact', {})
-                                if isinstance(contact_obj, dict):
-                                    phone_number = contact_obj.get('value') or contact_obj.get('number') or contact_obj.get('phone_number') or ''
-                                
-                                # If not found in nested object, try top-level fields
-                                if not phone_number:
-                                    phone_number = (
-                                        msg_data.get('contact_value') or 
-                                        msg_data.get('from') or 
-                                        msg_data.get('from_number') or
-                                        msg_data.get('contact_number') or 
-                                        msg_data.get('number') or 
-                                        msg_data.get('phone_number') or
-                                        msg_data.get('to') or  # Sometimes 'to' field for received messages
-                                        ''
-                                    )
-                                
-                                # Clean phone number - remove any formatting but keep + and digits
-                                if phone_number:
-                                    import re
-                                    # Keep + and digits only
-                                    cleaned = re.sub(r'[^\d+]', '', str(phone_number))
-                                    if cleaned:
-                                        phone_number = cleaned
-                                
-                                # Extract date - try multiple field names
-                                # TextNow API might use different date field names
-                                msg_date = (
-                                    msg_data.get('read_at') or
-                                    msg_data.get('created_at') or
-                                    msg_data.get('date') or 
-                                    msg_data.get('timestamp') or 
-                                    msg_data.get('time') or
-                                    msg_data.get('sent_at') or
-                                    msg_data.get('received_at') or
-                                    msg_data.get('updated_at') or
-                                    ''
-                                )
-                                
-                                # Also check nested objects for date
-                                if not msg_date:
-                                    contact = msg_data.get('contact', {})
-                                    if isinstance(contact, dict):
-                                        msg_date = contact.get('date') or contact.get('timestamp') or contact.get('created_at') or ''
-                                
-                                # Convert date to ISO format if needed
-                                if isinstance(msg_date, (int, float)):
-                                    from datetime import datetime
-                                    # Handle both milliseconds and seconds
-                                    if msg_date > 1e10:
-                                        msg_date = datetime.fromtimestamp(msg_date / 1000).isoformat()
-                                    else:
-                                        msg_date = datetime.fromtimestamp(msg_date).isoformat()
-                                elif hasattr(msg_date, 'isoformat'):
-                                    msg_date = msg_date.isoformat()
-                                elif isinstance(msg_date, str):
-                                    # If it's already a string, try to parse it
-                                    if not msg_date or msg_date.strip() == '':
-                                        msg_date = datetime.now().isoformat()
-                                    else:
-                                        # If it's a valid ISO string, keep it
-                                        # Otherwise, try to parse common formats
-                                        try:
-                                            # Try parsing common date formats
-                                            for fmt in ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']:
-                                                try:
-                                                    parsed = datetime.strptime(msg_date, fmt)
-                                                    msg_date = parsed.isoformat()
-                                                    break
-                                                except:
-                                                    continue
-                                        except:
-                                            # If parsing fails, use current time
-                                            msg_date = datetime.now().isoformat()
-                                
-                                # If still no date, use current time as fallback
-                                if not msg_date or msg_date == '':
-                                    msg_date = datetime.now().isoformat()
-                                
-                                # Determine direction - check multiple fields
-                                # TextNow API: received messages have 'from' field with sender's number
-                                # Sent messages have 'to' field or 'contact_value' matches our number
-                                is_sent = (
-                                    msg_data.get('is_sent', False) or 
-                                    msg_data.get('direction', '').upper() == 'SENT' or
-                                    msg_data.get('from') == username or
-                                    msg_data.get('from_number') == username or
-                                    (msg_data.get('contact_value') == username) or
-                                    (not msg_data.get('from') and msg_data.get('to'))  # If no 'from', likely sent
-                                )
-                                direction = "SENT" if is_sent else "RECEIVED"
-                                
-                                # Only include received messages when getting all messages
-                                if direction != "RECEIVED":
-                                    continue
-                                
-                                # For received messages, ensure we have the sender's number
-                                if not phone_number and direction == "RECEIVED":
-                                    # Try to get from 'from' field if we haven't already
-                                    phone_number = msg_data.get('from') or msg_data.get('from_number') or ''
-                                
-                                # Check if read
-                                is_read = msg_data.get('read', False) or msg_data.get('is_read', False) or msg_data.get('read_status', False)
-                                
-                                # Check if media
-                                has_media = bool(msg_data.get('media_url') or msg_data.get('media') or msg_data.get('attachment') or msg_data.get('mms'))
-                                
-                                # Only add message if we have essential data
-                                if not phone_number:
-                                    # Skip messages without phone numbers
-                                    continue
-                                
-                                msg_result = {
-                                    "id": str(msg_id) if msg_id else f"msg_{hash(str(msg_data))}",
-                                    "content": str(msg_content) if msg_content else '',
-                                    "number": str(phone_number),  # Ensure it's a string
-                                    "date": str(msg_date) if msg_date else datetime.now().isoformat(),
-                                    "read": bool(is_read),
-                                    "direction": direction,
-                                    "type": "MULTIMEDIA" if has_media else "MESSAGE",
-                                }
-                                
-                                if msg_data.get('media_url'):
-                                    msg_result["media_url"] = msg_data.get('media_url')
-                                elif msg_data.get('media'):
-                                    msg_result["media_url"] = msg_data.get('media')
-                                elif msg_data.get('attachment'):
-                                    msg_result["media_url"] = msg_data.get('attachment')
-                                
-                                result.append(msg_result)
-                            except Exception as e:
-                                # Log error for debugging but continue processing other messages
-                                # Include the message data keys in the error for debugging
-                                import traceback
-                                # Add error to debug info if available
-                                if debug_info and isinstance(debug_info, dict):
-                                    if "errors" not in debug_info:
-                                        debug_info["errors"] = []
-                                    debug_info["errors"].append({
-                                        "error": str(e),
-                                        "message_keys": list(msg_data.keys()) if isinstance(msg_data, dict) else [],
-                                        "traceback": traceback.format_exc()[:500]  # First 500 chars
-                                    })
-                                # Don't add to result, just continue
-                                continue
-                    
-                    # Include debug info in the response
-                    if debug_info:
-                        result.append({"debug": debug_info})
-                    
-                    elif response.status_code == 403:
-                        return [{"error": "403 Forbidden: Cookie expired or invalid"}]
-                    elif response.status_code == 401:
-                        return [{"error": "401 Unauthorized: Invalid credentials"}]
-                    else:
-                        return [{"error": f"API request failed with status {response.status_code}"}]
-                except Exception as e:
-                    # If API call fails, return error in result
-                    return [{"error": f"Failed to get all messages: {str(e)}"}]
-                
-            return result
+                            msg_result = normalizer.normalize(msg_data)
+                        if msg_result is None:
+                            skipped += 1
+                            continue
+                        if store is None:
+                            yield msg_result
+                            yielded += 1
+                            if num_messages is not None and yielded >= num_messages:
+                                break
+                        else:
+                            new_messages.append(msg_result)
+                    except Exception as e:
+                        # Skip the message but continue processing the others
+                        skipped += 1
+                        if diagnostics is not None:
+                            record_message_error(diagnostics, msg_data, e)
+                        continue
+
+                if store is None and num_messages is not None and yielded >= num_messages:
+                    # Enough messages: stop paging (at most one prefetched page is wasted)
+                    pages.close()
+                    break
+
+            if diagnostics is not None:
+                diagnostics["debug_pages"] = page_count
+            if timed:
+                self.timings.add("normalize", normalize_seconds)
+                self.timings.count("pages", page_count)
+                self.timings.count("messages_parsed", parsed)
+                self.timings.count("messages_skipped", skipped)
+
+            if store is not None:
+                with self.timings.phase("store"):
+                    store.save_messages(username, new_messages, replace=full_sync or cursor is None)
+                    if last_message_id is not None:
+                        store.set_cursor(username, last_message_id, str(last_date) if last_date else None)
+                    update_conversation_index(username, new_messages, replace=full_sync or cursor is None)
+                if diagnostics is not None:
+                    diagnostics["debug_new_messages"] = len(new_messages)
+                messages = store.iter_messages(username, limit=num_messages)
+            else:
+                messages = ()
+        except UpstreamError as e:
+            if e.status_code == 403:
+                yield {"error": "403 Forbidden: Cookie expired or invalid"}
+            elif e.status_code == 401:
+                yield {"error": "401 Unauthorized: Invalid credentials"}
+            else:
+                yield {"error": f"API request failed with status {e.status_code}"}
+            return
         except Exception as e:
-            return [{"error": str(e)}]
+            # If API call fails, return error in result
+            yield {"error": f"Failed to get all messages: {str(e)}"}
+            return
 
+        yield from messages
 
-def strip_ansi_codes(text: str) -> str:
-    """Remove ANSI escape codes from text"""
-    ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-    return ansi_escape.sub('', text)
+    def _iter_message_pages(self, direction: str = "past", start_message_id: str = None,
+                            page_size: int = MAX_MESSAGE_PAGE_SIZE, max_pages: int = 100):
+        """Yield (response data, raw messages) for each page of the all-messages API
 
-def main():
-    """CLI interface for the service"""
-    if len(sys.argv) < 2:
-        error_msg = json.dumps({"error": "Invalid arguments"})
-        print(error_msg)
-        sys.exit(1)
+        Pages are requested with `start_message_id` set to the oldest ("past")
+        or newest ("future") message id of the previous page. The next page is
+        fetched in the background while the caller processes the current one.
+        Stops at an empty or short page, after `max_pages`, or when the upstream
+        makes no progress (ignores the cursor), so pages are never repeated.
+        """
+        from concurrent.futures import ThreadPoolExecutor
 
-    command = sys.argv[1]
-    
-    try:
-        # Read input from stdin
-        stdin_data = sys.stdin.read()
-        if not stdin_data:
-            error_msg = json.dumps({"error": "No input data provided"})
-            print(error_msg)
-            sys.exit(1)
-            
-        input_data = json.loads(stdin_data)
-        username = input_data.get("username")
-        sid_cookie = input_data.get("sid_cookie")
-        user_agent = input_data.get("user_agent")  # User agent from browser (required per GitHub issue #39)
-        
-        if not username or not sid_cookie:
-            error_msg = json.dumps({"error": "Missing username or sid_cookie"})
-            print(error_msg)
-            sys.exit(1)
-        
-        service = TextNowService(username, sid_cookie, user_agent)
-        
-        if command == "send_sms":
-            number = input_data.get("number")
-            message = input_data.get("message")
-            if not number or not message:
-                error_msg = json.dumps({"error": "Missing number or message"})
-                print(error_msg)
-                sys.exit(1)
-            result = service.send_sms(number, message)
-            # Ensure clean JSON output without any extra formatting
-            output = json.dumps(result, ensure_ascii=False)
-            print(output)
-        
-        elif command == "send_media":
-            number = input_data.get("number")
+        # The upstream never returns more than MAX_MESSAGE_PAGE_SIZE per page, so
+        # a larger request would look like a short (last) page after one fetch
+        page_size = max(1, min(int(page_size or MAX_MESSAGE_PAGE_SIZE), MAX_MESSAGE_PAGE_SIZE))
+
+        def fetch(start_id):
+            params = {"direction": direction, "page_size": page_size}
+            if start_id is not None:
+                params["start_message_id"] = start_id
+            # TextNow API endpoint: https://www.textnow.com/api/users/{username}/messages
+            # The account session already carries the cookie and user agent
+            response = self._upstream(self.session.request, 'GET', f"/api/users/{self.username}/messages",
+                                      params=params, headers={'Content-Type': 'application/json'})
+            if response.status_code != 200:
+                raise UpstreamError(response.status_code)
+            self.timings.count("bytes_received", len(response.content))
+            with self.timings.phase("parse"):
+                data = response.json()
+            messages_data = (data.get('messages', []) or data.get('data', []) or []) if isinstance(data, dict) else []
+            return data, messages_data
+
+        prefetch = ThreadPoolExecutor(max_workers=1)
+        try:
+            future = prefetch.submit(fetch, start_message_id)
+            cursor = start_message_id
+            for page_number in range(max_pages):
+                data, messages_data = future.result()
+                next_cursor = page_cursor(messages_data, direction)
+                if page_number > 0 and (not messages_data or next_cursor == cursor):
+                    return
+
+                more = next_cursor is not None and len(messages_data) >= page_size and page_number + 1 < max_pages
+                if more:
+                    future = prefetch.submit(fetch, next_cursor)
+                yield data, messages_data
+                if not more:
+                    return
+                cursor = next_cursor
+        finally:
+            prefetch.shutdown(wait=False)
+
+
+    def iter_watch(self, phone_number: str = None, num_messages: int = 50, min_interval: float = 2.0,
+                   max_interval: float = 30.0, backoff: float = 2.0, duration: float = None,
+                   max_polls: int = None, include_existing: bool = True, stop_event: threading.Event = None):
+        """Poll for messages and yield an event for each new or changed one
+
+        Events are {"event": "message", "message": {...}} for unseen messages,
+        {"event": "update", ...} when a seen message changes (e.g. is read), and
+        {"event": "error", "error": ...} when a poll fails. Without a number the
+        polls go through the message store, so each one only fetches messages
+        newer than the sync cursor.
+
+        The interval starts at `min_interval`, grows by `backoff` after every
+        poll without events (up to `max_interval`) and drops back after activity.
+        Stops after `duration` seconds or `max_polls` polls, when `stop_event` is
+        set, or on an authentication error; the last event is {"event": "stopped"}.
+        """
+        seen = OrderedDict()  # message key -> fingerprint, bounded
+        max_seen = max(WATCH_MAX_SEEN, num_messages or 0)
+        deadline = time.monotonic() + duration if duration else None
+        interval = min_interval
+        polls = 0
+        reason = "max_polls"
+
+        while max_polls is None or polls < max_polls:
+            polls += 1
+            events = 0
+            error = None
+            for message in self.iter_messages(phone_number, num_messages):
+                if "error" in message:
+                    error = message["error"]
+                    continue
+                key, fingerprint = message_fingerprint(message)
+                previous = seen.get(key)
+                seen[key] = fingerprint
+                seen.move_to_end(key)
+                if previous == fingerprint:
+                    continue
+                if polls == 1 and not include_existing:
+                    continue
+                events += 1
+                yield {"event": "message" if previous is None else "update", "message": message}
+            while len(seen) > max_seen:
+                seen.popitem(last=False)
+
+            if error is not None:
+                yield {"event": "error", "error": error}
+                if error.startswith(("401", "403")):
+                    reason = "unauthorized"
+                    break
+            interval = min_interval if events else min(max_interval, interval * backoff)
+
+            if deadline is not None and time.monotonic() + interval > deadline:
+                reason = "duration"
+                break
+            if max_polls is not None and polls >= max_polls:
+                break
+            if stop_event is not None:
+                if stop_event.wait(interval):
+                    reason = "shutdown"
+                    break
+            else:
+                time.sleep(interval)
+
+        yield {"event": "stopped", "reason": reason, "polls": polls}
+
+
+def page_cursor(messages_data: list, direction: str):
+    """Message id to continue paging from: the oldest id going past, the newest going future"""
+    cursor = None
+    for msg_data in messages_data:
+        message_id = msg_data.get('id') if isinstance(msg_data, dict) else None
+        if message_id is None:
+            continue
+        if cursor is None or is_newer_message_id(message_id, cursor) == (direction == "future"):
+            cursor = str(message_id)
+    return cursor
+
+
+# Sample rate for env-enabled diagnostics: 1 in N calls (TEXTNOW_DIAGNOSTICS_SAMPLE, default 100)
+DIAGNOSTICS_SAMPLE = max(1, int(os.environ.get('TEXTNOW_DIAGNOSTICS_SAMPLE', '100')))
+# Private generator: pythontextnow's user agent helper reseeds the global one
+_diagnostics_random = random.Random()
+
+
+def new_diagnostics(input_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Diagnostics dict for this call, or None when diagnostics are off
+
+    Off by default. A request can ask for them with "diagnostics": true;
+    TEXTNOW_DIAGNOSTICS=1 turns them on for a random 1 in
+    TEXTNOW_DIAGNOSTICS_SAMPLE calls. They are returned under a separate
+    "diagnostics" key, never mixed into "messages".
+    """
+    if input_data.get("diagnostics"):
+        return {}
+    if os.environ.get('TEXTNOW_DIAGNOSTICS') == '1' and _diagnostics_random.randrange(DIAGNOSTICS_SAMPLE) == 0:
+        return {"sampled": True}
+    return None
+
+
+def describe_response(diagnostics: Dict[str, Any], data, messages_data: list, incremental: bool = False):
+    """Record the shape of an all-messages response to help diagnose parsing issues"""
+    diagnostics.update({
+        "debug_total_messages": len(messages_data),
+        "debug_response_keys": list(data.keys()) if isinstance(data, dict) else [],
+        "debug_response_structure": str(type(data)),
+        "debug_incremental": incremental,
+    })
+    if messages_data:
+        first_msg = messages_data[0]
+        if isinstance(first_msg, dict):
+            # Output the FULL first message (all fields) so we can see the exact structure
+            all_keys = set()
+            # Collect all unique keys from first 5 messages
+            for msg in messages_data[:5]:
+                if isinstance(msg, dict):
+                    all_keys.update(msg.keys())
+            diagnostics.update({
+                "debug_first_message_keys": list(first_msg.keys()),
+                "debug_first_message_full": json.dumps(first_msg, default=str, indent=2),
+                "debug_all_message_keys": list(all_keys),
+            })
+    elif not incremental:
+        # Even if no messages, include info about the response
+        diagnostics["debug_no_messages"] = True
+        diagnostics["debug_full_response"] = json.dumps(data, default=str, indent=2)[:1000]  # First 1000 chars
+
+
+def record_message_error(diagnostics: Dict[str, Any], msg_data, error: Exception):
+    """Keep the error and message keys of a message that failed to normalize"""
+    import traceback
+    diagnostics.setdefault("errors", []).append({
+        "error": str(error),
+        "message_keys": list(msg_data.keys()) if isinstance(msg_data, dict) else [],
+        "traceback": traceback.format_exc()[:500]  # First 500 chars
+    })
+
+
+def stable_message_id(msg_data: Dict[str, Any]) -> str:
+    """Deterministic id for upstream messages that lack one (hash() is salted per process)"""
+    digest = hashlib.sha1(json.dumps(msg_data, sort_keys=True, default=str).encode()).hexdigest()
+    return f"msg_{digest[:16]}"
+
+
+def is_newer_message_id(message_id, other_id) -> bool:
+    """TextNow message ids are increasing integers; compare them numerically when possible"""
+    if other_id is None:
+        return True
+    message_id, other_id = str(message_id), str(other_id)
+    if message_id.isdigit() and other_id.isdigit():
+        return int(message_id) > int(other_id)
+    return message_id > other_id
+
+
+# watch polling interval bounds (seconds) and messages remembered for deduplication
+WATCH_MIN_INTERVAL = float(os.environ.get('TEXTNOW_WATCH_MIN_INTERVAL', '2'))
+WATCH_MAX_INTERVAL = float(os.environ.get('TEXTNOW_WATCH_MAX_INTERVAL', '30'))
+WATCH_MAX_SEEN = 10000
+
+
+def message_fingerprint(message: Dict[str, Any]):
+    """(dedup key, content hash) of a normalized message
+
+    Messages without an id are keyed by their content. Their date is left out
+    of the hash, since the per-conversation path stamps them with the poll time.
+    """
+    fields = {k: v for k, v in message.items() if message.get("id") or k != "date"}
+    digest = hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+    if message.get("id"):
+        return str(message["id"]), digest
+    return f"h:{digest}", digest
+
+
+# Keep + and digits only
+PHONE_CLEAN_RE = re.compile(r'[^\d+]')
+
+
+def format_utc(value: datetime) -> str:
+    """Canonical message date: UTC ISO 8601 with a Z suffix, milliseconds only when non-zero"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    # %-formatting the fields is several times faster than isoformat()/strftime()
+    if value.microsecond:
+        return '%04d-%02d-%02dT%02d:%02d:%02d.%03dZ' % (
+            value.year, value.month, value.day, value.hour, value.minute, value.second, value.microsecond // 1000)
+    return '%04d-%02d-%02dT%02d:%02d:%02dZ' % (
+        value.year, value.month, value.day, value.hour, value.minute, value.second)
+
+
+def utc_now() -> str:
+    return format_utc(datetime.now(timezone.utc))
+
+
+class TimestampParser:
+    """Normalize raw message dates to canonical UTC strings (see format_utc)
+
+    Canonical strings (what TextNow sends) are returned untouched. Other ISO
+    strings go through datetime.fromisoformat; anything else is tried against
+    STRPTIME_FORMATS, and the format that matched is remembered and tried first
+    for the rest of the batch, so use one parser per batch. Epoch numbers are
+    seconds, or milliseconds above 1e10. Naive values are taken as UTC.
+    Missing dates become the current time; unparseable strings are kept.
+    """
+
+    STRPTIME_FORMATS = (
+        '%m/%d/%Y %H:%M:%S',
+        '%m/%d/%Y %H:%M',
+        '%m/%d/%Y',
+        '%a, %d %b %Y %H:%M:%S %Z',
+        '%Y/%m/%d %H:%M:%S',
+    )
+    EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+    def __init__(self):
+        self._format = None
+        self._days = {}  # days since the epoch -> 'YYYY-MM-DDT'
+
+    def parse(self, value) -> str:
+        if value.__class__ is str:
+            if len(value) == 20 and value[19] == 'Z' and value[10] == 'T':
+                return value
+            return self._parse_string(value)
+        if isinstance(value, (int, float)):
+            return self.format_epoch(value)
+        if isinstance(value, datetime):
+            return format_utc(value)
+        if not value:
+            return utc_now()
+        if hasattr(value, 'isoformat'):
+            return self._parse_string(value.isoformat())
+        return str(value)
+
+    def parse_many(self, values) -> List[str]:
+        """parse() for a whole batch, with no per-value type dispatch for epoch numbers"""
+        parse, format_epoch = self.parse, self.format_epoch
+        return [
+            format_epoch(value) if value.__class__ is int or value.__class__ is float else parse(value)
+            for value in values
+        ]
+
+    def format_epoch(self, value) -> str:
+        """Epoch seconds, or milliseconds above 1e10, as a canonical UTC string"""
+        if value > 1e10:
+            whole, millis = divmod(int(value), 1000)
+        else:
+            whole = int(value // 1)
+            millis = int((value - whole) * 1000)
+        # Calendar math once per day (messages cluster in few days), plain arithmetic for the time
+        day, seconds = divmod(whole, 86400)
+        prefix = self._days.get(day)
+        if prefix is None:
+            prefix = self._days[day] = (self.EPOCH + timedelta(days=day)).strftime('%Y-%m-%dT')
+        hours, seconds = divmod(seconds, 3600)
+        minutes, seconds = divmod(seconds, 60)
+        if millis:
+            return '%s%02d:%02d:%02d.%03dZ' % (prefix, hours, minutes, seconds, millis)
+        return '%s%02d:%02d:%02dZ' % (prefix, hours, minutes, seconds)
+
+    def _parse_string(self, value: str) -> str:
+        text = value.strip()
+        if not text:
+            return utc_now()
+        try:
+            # fromisoformat only accepts a 'Z' suffix from Python 3.11 on
+            parsed = datetime.fromisoformat(text[:-1] + '+00:00' if text[-1] in 'Zz' else text)
+        except ValueError:
+            parsed = None
+        if parsed is not None:
+            if len(text) == 19 and parsed.tzinfo is None and text[4] == '-' and text[10] in ' T':
+                # 'YYYY-MM-DD HH:MM:SS' or without the Z: already valid, just reshape it
+                # (other 19-character ISO forms, e.g. basic '20240101T120000.123', are not)
+                return text[:10] + 'T' + text[11:] + 'Z'
+            return format_utc(parsed)
+        if self._format is not None:
+            try:
+                return format_utc(datetime.strptime(text, self._format))
+            except ValueError:
+                pass
+        for fmt in self.STRPTIME_FORMATS:
+            try:
+                parsed = datetime.strptime(text, fmt)
+            except ValueError:
+                continue
+            self._format = fmt
+            return format_utc(parsed)
+        return value
+
+
+_default_timestamps = TimestampParser()
+
+
+def normalize_date_value(msg_date) -> str:
+    """Convert a raw date value (epoch seconds/ms, datetime or string) to a canonical UTC string"""
+    return _default_timestamps.parse(msg_date)
+
+
+def normalize_raw_message(msg_data: Dict[str, Any], username: str, parse_date=normalize_date_value) -> Dict[str, Any]:
+    """Normalize one raw message from the all-messages API
+
+    Returns None for messages that are skipped (sent messages, or no phone number).
+    `parse_date` normalizes the date (a batch's TimestampParser.parse).
+    """
+    # Extract message information
+    msg_id = msg_data.get('id') or msg_data.get('message_id') or msg_data.get('_id')
+    msg_content = msg_data.get('content') or msg_data.get('message') or msg_data.get('text') or msg_data.get('body') or ''
+    
+    # Extract phone number - for received messages, it's usually in 'contact_value', 'from', or 'contact_number'
+    # TextNow API structure varies, so check multiple fields
+    # Try to get phone number from nested contact object first
+    phone_number = ''
+    contact_obj = msg_data.get('contact', {})
+    if isinstance(contact_obj, dict):
+        phone_number = contact_obj.get('value') or contact_obj.get('number') or contact_obj.get('phone_number') or ''
+    
+    # If not found in nested object, try top-level fields
+    if not phone_number:
+        phone_number = (
+            msg_data.get('contact_value') or 
+            msg_data.get('from') or 
+            msg_data.get('from_number') or
+            msg_data.get('contact_number') or 
+            msg_data.get('number') or 
+            msg_data.get('phone_number') or
+            msg_data.get('to') or  # Sometimes 'to' field for received messages
+            ''
+        )
+    
+    # Clean phone number - remove any formatting but keep + and digits
+    if phone_number:
+        # Keep + and digits only
+        cleaned = PHONE_CLEAN_RE.sub('', str(phone_number))
+        if cleaned:
+            phone_number = cleaned
+    
+    # Extract date - try multiple field names
+    # TextNow API might use different date field names
+    msg_date = (
+        msg_data.get('read_at') or
+        msg_data.get('created_at') or
+        msg_data.get('date') or 
+        msg_data.get('timestamp') or 
+        msg_data.get('time') or
+        msg_data.get('sent_at') or
+        msg_data.get('received_at') or
+        msg_data.get('updated_at') or
+        ''
+    )
+    
+    # Also check nested objects for date
+    if not msg_date:
+        contact = msg_data.get('contact', {})
+        if isinstance(contact, dict):
+            msg_date = contact.get('date') or contact.get('timestamp') or contact.get('created_at') or ''
+    
+    msg_date = parse_date(msg_date)
+    
+    # Determine direction - check multiple fields
+    # TextNow API: received messages have 'from' field with sender's number
+    # Sent messages have 'to' field or 'contact_value' matches our number
+    is_sent = (
+        msg_data.get('is_sent', False) or 
+        str(msg_data.get('direction', '')).upper() == 'SENT' or
+        msg_data.get('from') == username or
+        msg_data.get('from_number') == username or
+        (msg_data.get('contact_value') == username) or
+        (not msg_data.get('from') and msg_data.get('to'))  # If no 'from', likely sent
+    )
+    direction = "SENT" if is_sent else "RECEIVED"
+    
+    # Only include received messages when getting all messages
+    if direction != "RECEIVED":
+        return None
+    
+    # For received messages, ensure we have the sender's number
+    if not phone_number and direction == "RECEIVED":
+        # Try to get from 'from' field if we haven't already
+        phone_number = msg_data.get('from') or msg_data.get('from_number') or ''
+    
+    # Check if read
+    is_read = msg_data.get('read', False) or msg_data.get('is_read', False) or msg_data.get('read_status', False)
+    
+    # Check if media
+    has_media = bool(msg_data.get('media_url') or msg_data.get('media') or msg_data.get('attachment') or msg_data.get('mms'))
+    
+    # Only add message if we have essential data
+    if not phone_number:
+        # Skip messages without phone numbers
+        return None
+    
+    msg_result = {
+        "id": str(msg_id) if msg_id else stable_message_id(msg_data),
+        "content": str(msg_content) if msg_content else '',
+        "number": str(phone_number),  # Ensure it's a string
+        "date": str(msg_date) if msg_date else datetime.now().isoformat(),
+        "read": bool(is_read),
+        "direction": direction,
+        "type": "MULTIMEDIA" if has_media else "MESSAGE",
+    }
+    
+    if msg_data.get('media_url'):
+        msg_result["media_url"] = msg_data.get('media_url')
+    elif msg_data.get('media'):
+        msg_result["media_url"] = msg_data.get('media')
+    elif msg_data.get('attachment'):
+        msg_result["media_url"] = msg_data.get('attachment')
+    
+    return msg_result
+
+
+# Fallback chains of normalize_raw_message, in the same order
+ID_KEYS = ('id', 'message_id', '_id')
+CONTENT_KEYS = ('content', 'message', 'text', 'body')
+PHONE_KEYS = ('contact_value', 'from', 'from_number', 'contact_number', 'number', 'phone_number', 'to')
+DATE_KEYS = ('read_at', 'created_at', 'date', 'timestamp', 'time', 'sent_at', 'received_at', 'updated_at')
+READ_KEYS = ('read', 'is_read', 'read_status')
+MEDIA_KEYS = ('media_url', 'media', 'attachment')
+
+# Returned by compiled extractors for rows that don't match the learned schema
+SLOW_PATH = object()
+
+
+def compile_message_extractor(schema_keys, username: str, parse_date=normalize_date_value):
+    """Build a normalizer specialized for raw messages with exactly `schema_keys`
+
+    Every fallback chain of normalize_raw_message is cut down to the keys the
+    schema actually has, and the whole extractor is generated as one function,
+    so a row costs a handful of dict lookups instead of dozens of .get() calls.
+    Because a row must have the exact same key set, the first truthy value of
+    the reduced chain is the first truthy value of the full chain, and results
+    are identical to the slow path. Other rows return SLOW_PATH.
+
+    Returns None for schemas the slow path handles specially (nested `contact`).
+    """
+    keys = frozenset(schema_keys)
+    if 'contact' in keys:
+        return None
+
+    def chain(candidates, default="''"):
+        present = [f"row[{k!r}]" for k in candidates if k in keys]
+        return " or ".join(present + [default])
+
+    is_sent_terms = []
+    if 'is_sent' in keys:
+        is_sent_terms.append("row['is_sent']")
+    if 'direction' in keys:
+        is_sent_terms.append("str(row['direction']).upper() == 'SENT'")
+    for key in ('from', 'from_number', 'contact_value'):
+        if key in keys:
+            is_sent_terms.append(f"row[{key!r}] == username")
+    if 'to' in keys:
+        is_sent_terms.append("(not row['from'] and row['to'])" if 'from' in keys else "row['to']")
+
+    media_terms = [f"row[{k!r}]" for k in MEDIA_KEYS + ('mms',) if k in keys]
+
+    source = f"""
+def extract(row):
+    if row.keys() != schema_keys:
+        return SLOW_PATH
+    phone_number = {chain(PHONE_KEYS)}
+    # Already-clean numbers (only + and decimal digits) skip the regex
+    if phone_number and not (phone_number.__class__ is str and phone_number.replace('+', '').isdecimal()):
+        cleaned = clean_phone('', str(phone_number))
+        if cleaned:
+            phone_number = cleaned
+    msg_date = {chain(DATE_KEYS)}
+    # Canonical UTC strings are returned untouched by the parser; skip the call
+    if not (msg_date.__class__ is str and len(msg_date) == 20 and msg_date[19] == 'Z' and msg_date[10] == 'T'):
+        msg_date = parse_date(msg_date)
+    if {" or ".join(is_sent_terms) or "False"}:
+        return None
+    if not phone_number:
+        phone_number = {chain(('from', 'from_number'))}
+        if not phone_number:
+            return None
+    msg_id = {chain(ID_KEYS, 'None')}
+    msg_content = {chain(CONTENT_KEYS)}
+    result = {{
+        "id": str(msg_id) if msg_id else stable_message_id(row),
+        "content": str(msg_content) if msg_content else '',
+        "number": str(phone_number),
+        "date": str(msg_date),
+        "read": bool({chain(READ_KEYS, 'False')}),
+        "direction": "RECEIVED",
+        "type": "MULTIMEDIA" if {" or ".join(media_terms) or "False"} else "MESSAGE",
+    }}
+    media_url = {chain(MEDIA_KEYS, 'None')}
+    if media_url:
+        result["media_url"] = media_url
+    return result
+"""
+    namespace = {
+        'schema_keys': keys,
+        'username': username,
+        'clean_phone': PHONE_CLEAN_RE.sub,
+        'parse_date': parse_date,
+        'stable_message_id': stable_message_id,
+        'SLOW_PATH': SLOW_PATH,
+    }
+    exec(source, namespace)
+    return namespace['extract']
+
+
+class MessageNormalizer:
+    """Normalize a batch of raw messages with an extractor compiled for the batch's schema
+
+    The schema is learned from the first message. Rows that don't match it go
+    through normalize_raw_message; after `relearn_after` misses in a row the
+    extractor is recompiled from the current row's schema.
+    """
+
+    def __init__(self, username: str, relearn_after: int = 32):
+        self.username = username
+        self.relearn_after = relearn_after
+        # One parser per batch, so a detected date format is reused for the whole batch
+        self.timestamps = TimestampParser()
+        self.fast = 0
+        self.slow = 0
+        self._extract = None
+        self._misses = 0
+
+    def normalize(self, msg_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Same result as normalize_raw_message(msg_data, username)"""
+        if self._extract is None or self._misses >= self.relearn_after:
+            self._extract = compile_message_extractor(msg_data.keys(), self.username, self.timestamps.parse) or False
+            self._misses = 0
+
+        if self._extract:
+            result = self._extract(msg_data)
+            if result is not SLOW_PATH:
+                self.fast += 1
+                self._misses = 0
+                return result
+            self._misses += 1
+
+        self.slow += 1
+        return normalize_raw_message(msg_data, self.username, self.timestamps.parse)
+
+
+class MessageStore:
+    """Local SQLite (WAL mode) store of normalized messages plus per-account sync cursors
+
+    Messages are keyed by (account, message id), so re-saving a message is an
+    update, not a duplicate. One connection is shared by all threads.
+
+    An FTS5 index over content and number, maintained by triggers, backs
+    search(); SQLite builds without FTS5 fall back to LIKE scans.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            account TEXT NOT NULL,
+            id TEXT NOT NULL,
+            number TEXT NOT NULL,
+            content TEXT NOT NULL,
+            date TEXT NOT NULL,
+            read INTEGER NOT NULL,
+            direction TEXT NOT NULL,
+            type TEXT NOT NULL,
+            media_url TEXT,
+            PRIMARY KEY (account, id)
+        );
+        CREATE INDEX IF NOT EXISTS messages_account_date ON messages (account, date);
+        CREATE TABLE IF NOT EXISTS sync_cursors (
+            account TEXT PRIMARY KEY,
+            last_message_id TEXT,
+            last_date TEXT,
+            synced_at REAL NOT NULL
+        );
+    """
+
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE messages_fts USING fts5(
+            content, number, content='messages', content_rowid='rowid'
+        );
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content, number) VALUES (new.rowid, new.content, new.number);
+        END;
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content, number)
+            VALUES ('delete', old.rowid, old.content, old.number);
+        END;
+        CREATE TRIGGER messages_fts_update AFTER UPDATE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content, number)
+            VALUES ('delete', old.rowid, old.content, old.number);
+            INSERT INTO messages_fts (rowid, content, number) VALUES (new.rowid, new.content, new.number);
+        END;
+        INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
+    """
+
+    def __init__(self, path: str):
+        import sqlite3
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        # WAL lets readers (other worker processes) run while a sync is writing
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # INSERT OR REPLACE must fire the delete trigger too, or the search index keeps stale rows
+        self._conn.execute("PRAGMA recursive_triggers=ON")
+        self._conn.executescript(self.SCHEMA)
+        self.fts = self._init_fts()
+
+    def _init_fts(self) -> bool:
+        """Create the search index (indexing existing messages) unless present; False without FTS5"""
+        import sqlite3
+
+        exists = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'").fetchone()
+        if exists:
+            return True
+        try:
+            self._conn.executescript(f"BEGIN; {self.FTS_SCHEMA} COMMIT;")
+            return True
+        except sqlite3.OperationalError:
+            self._conn.rollback()
+            return False
+
+    def get_cursor(self, account: str) -> Dict[str, Any]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_message_id, last_date, synced_at FROM sync_cursors WHERE account = ?", (account,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def set_cursor(self, account: str, last_message_id: str, last_date: str = None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sync_cursors (account, last_message_id, last_date, synced_at) VALUES (?, ?, ?, ?)",
+                (account, last_message_id, last_date, time.time()),
+            )
+
+    def save_messages(self, account: str, messages: List[Dict[str, Any]], replace: bool = False):
+        """Upsert normalized messages; `replace` drops the account's stored messages first (full sync)"""
+        rows = [
+            (account, m["id"], m["number"], m["content"], m["date"], int(bool(m["read"])),
+             m["direction"], m["type"], m.get("media_url"))
+            for m in messages
+        ]
+        with self._lock, self._conn:
+            if replace:
+                self._conn.execute("DELETE FROM messages WHERE account = ?", (account,))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO messages (account, id, number, content, date, read, direction, type, media_url) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def has_media_url(self, account: str, url: str) -> bool:
+        """Whether `url` is the media of one of the account's stored messages"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM messages WHERE account = ? AND (media_url = ? OR (type = 'MULTIMEDIA' AND content = ?)) "
+                "LIMIT 1", (account, url, url)).fetchone()
+        return row is not None
+
+    def get_messages(self, account: str, limit: int = None) -> List[Dict[str, Any]]:
+        """Stored messages for the account, most recent first"""
+        return list(self.iter_messages(account, limit=limit))
+
+    def iter_messages(self, account: str, limit: int = None, batch_size: int = 500):
+        """Yield stored messages for the account, most recent first
+
+        Reads in keyset-paginated batches, so the lock is only held per batch and
+        memory stays flat however large the history is.
+        """
+        columns = "id, content, number, date, read, direction, type, media_url"
+        last = None
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = batch_size if remaining is None else min(batch_size, remaining)
+            if last is None:
+                query = f"SELECT {columns} FROM messages WHERE account = ? ORDER BY date DESC, id DESC LIMIT ?"
+                params = (account, size)
+            else:
+                query = (f"SELECT {columns} FROM messages WHERE account = ? AND (date < ? OR (date = ? AND id < ?)) "
+                         "ORDER BY date DESC, id DESC LIMIT ?")
+                params = (account, last["date"], last["date"], last["id"], size)
+            with self._lock:
+                rows = self._conn.execute(query, params).fetchall()
+            for row in rows:
+                yield message_from_row(row)
+            if len(rows) < size:
+                return
+            last = rows[-1]
+            if remaining is not None:
+                remaining -= len(rows)
+
+
+    def search(self, account: str, query: str, number: str = None, since: str = None, until: str = None,
+               limit: int = 20, offset: int = 0, order: str = "date") -> Dict[str, Any]:
+        """Messages matching every term and "quoted phrase" of `query`, most recent first
+
+        A trailing * makes a term a prefix match. `number` and the `since` /
+        `until` dates (ISO strings, inclusive) narrow the results; `order` is
+        "date" or "relevance". Returns one page plus the offset of the next.
+        """
+        terms = parse_search_query(query)
+        if not terms:
+            raise ValueError("Empty search query")
+
+        filters, params = ["m.account = ?"], [account]
+        if number:
+            filters.append("m.number = ?")
+            params.append(number)
+        if since:
+            filters.append("m.date >= ?")
+            params.append(since)
+        if until:
+            # Dates are ISO strings: a bare date covers the whole day
+            filters.append("m.date <= ?")
+            params.append(until if 'T' in until else f"{until}T23:59:59~")
+
+        columns = "m.id, m.content, m.number, m.date, m.read, m.direction, m.type, m.media_url"
+        if self.fts:
+            match = " ".join('"{}"{}'.format(text.replace('"', '""'), "*" if prefix else "") for text, prefix in terms)
+            sql = (f"SELECT {columns} FROM messages_fts JOIN messages m ON m.rowid = messages_fts.rowid "
+                   f"WHERE messages_fts MATCH ? AND {' AND '.join(filters)} "
+                   f"ORDER BY {'messages_fts.rank' if order == 'relevance' else 'm.date DESC, m.id DESC'} LIMIT ? OFFSET ?")
+            params = [match] + params
+        else:
+            for text, prefix in terms:
+                filters.append("m.content LIKE ? ESCAPE '\\'")
+                escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                params.append(f"%{escaped}%")
+            sql = f"SELECT {columns} FROM messages m WHERE {' AND '.join(filters)} ORDER BY m.date DESC, m.id DESC LIMIT ? OFFSET ?"
+
+        # One extra row tells whether there is a next page
+        with self._lock:
+            rows = self._conn.execute(sql, params + [limit + 1, offset]).fetchall()
+        return {
+            "messages": [message_from_row(row) for row in rows[:limit]],
+            "offset": offset,
+            "next_offset": offset + limit if len(rows) > limit else None,
+        }
+
+
+def parse_search_query(query: str):
+    """Split a search query into (text, is_prefix) terms; "quoted text" is one phrase"""
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', query or ""):
+        text = (phrase or word).strip()
+        prefix = not phrase and text.endswith("*")
+        text = text.rstrip("*").strip()
+        if text:
+            terms.append((text, prefix))
+    return terms
+
+
+def message_from_row(row) -> Dict[str, Any]:
+    """Stored row -> the same dict shape get_messages returns"""
+    message = {
+        "id": row["id"],
+        "content": row["content"],
+        "number": row["number"],
+        "date": row["date"],
+        "read": bool(row["read"]),
+        "direction": row["direction"],
+        "type": row["type"],
+    }
+    if row["media_url"]:
+        message["media_url"] = row["media_url"]
+    return message
+
+
+# Where local state (message store, ...) lives; Next.js keeps users.json there too
+DATA_DIR = os.environ.get('TEXTNOW_DATA_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+_message_store = None
+_message_store_lock = threading.Lock()
+
+
+def get_message_store() -> MessageStore:
+    """Shared MessageStore, or None when disabled with TEXTNOW_MESSAGE_STORE=0"""
+    global _message_store
+    if os.environ.get('TEXTNOW_MESSAGE_STORE', '1') == '0':
+        return None
+    with _message_store_lock:
+        if _message_store is None:
+            _message_store = MessageStore(os.path.join(DATA_DIR, 'messages.db'))
+    return _message_store
+
+
+class ConversationIndex:
+    """Per-number thread summaries for one account, updated incrementally
+
+    For each number: the last message, the unread count (received messages
+    not read) and the message ids ordered by date. Messages are keyed by id,
+    so seeing a message again (e.g. now read) updates it instead of counting
+    it twice.
+    """
+
+    def __init__(self):
+        self.threads = {}  # number -> {"messages": {id: message}, "order": [(date, id)], "unread": int}
+        self._lock = threading.Lock()
+
+    def add(self, messages):
+        import bisect
+
+        with self._lock:
+            for message in messages:
+                number = message.get("number") or ""
+                thread = self.threads.get(number)
+                if thread is None:
+                    thread = self.threads[number] = {"messages": {}, "order": [], "unread": 0}
+                message_id = message["id"]
+                previous = thread["messages"].get(message_id)
+                if previous is not None:
+                    thread["order"].pop(bisect.bisect_left(thread["order"], (previous["date"], message_id)))
+                    thread["unread"] -= is_unread(previous)
+                thread["messages"][message_id] = message
+                bisect.insort(thread["order"], (message["date"], message_id))
+                thread["unread"] += is_unread(message)
+
+    def list_threads(self, offset: int = 0, limit: int = 20, include_ids: bool = False) -> Dict[str, Any]:
+        """Thread summaries, most recently active first"""
+        with self._lock:
+            ordered = sorted(self.threads.items(), key=lambda item: item[1]["order"][-1], reverse=True)
+            threads = []
+            for number, thread in ordered[offset:offset + limit]:
+                last_date, last_id = thread["order"][-1]
+                summary = {
+                    "number": number,
+                    "last_message": thread["messages"][last_id],
+                    "last_date": last_date,
+                    "unread": thread["unread"],
+                    "count": len(thread["order"]),
+                }
+                if include_ids:
+                    summary["message_ids"] = [message_id for _, message_id in reversed(thread["order"])]
+                threads.append(summary)
+        next_offset = offset + limit if offset + limit < len(ordered) else None
+        return {"threads": threads, "total": len(ordered), "offset": offset, "next_offset": next_offset}
+
+
+def is_unread(message: Dict[str, Any]) -> int:
+    return int(message.get("direction") == "RECEIVED" and not message.get("read"))
+
+
+# Conversation indexes by account, built from the message store on first use
+_conversation_indexes = {}
+_conversation_indexes_lock = threading.Lock()
+
+
+def get_conversation_index(account: str, store: MessageStore) -> ConversationIndex:
+    with _conversation_indexes_lock:
+        index = _conversation_indexes.get(account)
+        if index is None:
+            index = _conversation_indexes[account] = ConversationIndex()
+            index.add(store.iter_messages(account))
+    return index
+
+
+def update_conversation_index(account: str, messages: List[Dict[str, Any]], replace: bool = False):
+    """Apply newly synced messages to the account's index, if one was built"""
+    with _conversation_indexes_lock:
+        if replace:
+            # Rebuilt from the store on next use
+            _conversation_indexes.pop(account, None)
+        elif account in _conversation_indexes:
+            _conversation_indexes[account].add(messages)
+
+
+class CredentialHealth:
+    """Recent auth verdicts per (account, cookie hash) in SQLite, shared across processes
+
+    A rejection (401/403) is remembered for AUTH_FAILURE_TTL so later calls
+    with the same cookie fail fast, including in spawn-per-call mode; a good
+    verdict from check_session is remembered for SESSION_CHECK_TTL. A new
+    cookie has a new hash and starts out unknown. Errors opening or writing
+    the database only disable the cache.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS credential_health (
+            account TEXT NOT NULL,
+            cookie_hash TEXT NOT NULL,
+            status INTEGER NOT NULL,
+            checked_at REAL NOT NULL,
+            PRIMARY KEY (account, cookie_hash)
+        );
+    """
+
+    def __init__(self, path: str):
+        import sqlite3
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+
+    def get(self, account: str, cookie_hash: str):
+        """(status, checked_at) of an unexpired verdict, or None"""
+        import sqlite3
+
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT status, checked_at FROM credential_health WHERE account = ? AND cookie_hash = ?",
+                    (account, cookie_hash)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        status, checked_at = row
+        ttl = AUTH_FAILURE_TTL if status in AUTH_FAILURE_STATUSES else SESSION_CHECK_TTL
+        return (status, checked_at) if time.time() - checked_at < ttl else None
+
+    def record(self, account: str, cookie_hash: str, status: int):
+        import sqlite3
+
+        try:
+            with self._lock, self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO credential_health (account, cookie_hash, status, checked_at) "
+                    "VALUES (?, ?, ?, ?)", (account, cookie_hash, status, time.time()))
+                # Verdicts for the account's older cookies are no longer useful
+                self._conn.execute("DELETE FROM credential_health WHERE account = ? AND cookie_hash != ?",
+                                   (account, cookie_hash))
+        except sqlite3.Error:
+            pass
+
+
+_credential_health = None
+_credential_health_lock = threading.Lock()
+
+
+def get_credential_health() -> CredentialHealth:
+    """Shared CredentialHealth, or None when disabled with TEXTNOW_CREDENTIAL_CACHE=0 or unavailable"""
+    global _credential_health
+    if os.environ.get('TEXTNOW_CREDENTIAL_CACHE', '1') == '0':
+        return None
+    with _credential_health_lock:
+        if _credential_health is None:
+            try:
+                _credential_health = CredentialHealth(os.path.join(DATA_DIR, 'credentials.db'))
+            except Exception:
+                _credential_health = False
+    return _credential_health or None
+
+
+# Outbox delivery: worker threads in serve mode, attempts per job, lease before redelivery
+OUTBOX_WORKERS = int(os.environ.get('TEXTNOW_OUTBOX_WORKERS', '2'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('TEXTNOW_OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_LEASE = float(os.environ.get('TEXTNOW_OUTBOX_LEASE', '120'))
+OUTBOX_POLL_INTERVAL = 1.0
+# Finished (sent / failed) jobs are deleted after this many seconds, checked at most once per interval
+OUTBOX_RETENTION = float(os.environ.get('TEXTNOW_OUTBOX_RETENTION', str(7 * 24 * 3600)))
+OUTBOX_PURGE_INTERVAL = 3600.0
+# Payload fields only needed for delivery, removed once a job is finished
+OUTBOX_CREDENTIAL_KEYS = ("sid_cookie", "user_agent")
+# Send errors that retrying cannot fix
+PERMANENT_SEND_ERRORS = ("401", "403", "not a possible phone number", "File not found", "not an allowed media type",
+                         "Cannot get media type")
+
+
+class Outbox:
+    """Durable queue of outgoing sends in SQLite (WAL mode)
+
+    Jobs go queued -> sending -> sent / failed. A worker claims a job by
+    taking a lease; if it dies mid-send, the lease expires and the job is
+    delivered again (at-least-once). Jobs enqueued with the same idempotency
+    key for an account are stored once. Several processes can share the file.
+
+    Credentials are dropped from a job's payload when it finishes, and finished
+    jobs are deleted after OUTBOX_RETENTION seconds.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            account TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            idempotency_key TEXT,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            lease_owner TEXT,
+            lease_until REAL,
+            result TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS jobs_idempotency ON jobs (account, idempotency_key);
+        CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, next_attempt_at);
+    """
+
+    def __init__(self, path: str):
+        import sqlite3
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.media_dir = os.path.join(os.path.dirname(path) or '.', 'outbox_media')
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._purged_at = 0.0
+
+    def enqueue(self, account: str, kind: str, payload: Dict[str, Any], idempotency_key: str = None,
+                media_file: str = None):
+        """Store a job and return (job, created); an existing job is returned for a known idempotency key
+
+        `media_file` is copied into the outbox (by content hash, so callers may
+        delete theirs) and the copy becomes payload["file_path"]. The copy is
+        put in place in the same transaction that inserts the job, so a worker
+        finishing another job for the same file never deletes it in between.
+        """
+        import sqlite3
+        import uuid
+
+        if idempotency_key:
+            existing = self.find(account, idempotency_key)
+            if existing is not None:
+                return existing, False
+        stored = temp_path = None
+        if media_file is not None:
+            stored, temp_path = self._stage_media(media_file)
+            payload = dict(payload, file_path=stored)
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        try:
+            with self._lock, self._conn:
+                # Write lock across processes until commit (see release_media)
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._conn.execute(
+                    "INSERT INTO jobs (id, account, kind, payload, idempotency_key, status, next_attempt_at, "
+                    "created_at, updated_at) VALUES (?, ?, ?, ?, ?, 'queued', ?, ?, ?)",
+                    (job_id, account, kind, json.dumps(payload), idempotency_key, now, now, now),
+                )
+                if stored is not None and not os.path.exists(stored):
+                    if temp_path is None:
+                        # Deleted since it was staged: copy it again
+                        stored, temp_path = self._stage_media(media_file, stored)
+                    os.replace(temp_path, stored)
+                    temp_path = None
+        except sqlite3.IntegrityError:
+            # Same key enqueued concurrently (possibly by another process)
+            return self.find(account, idempotency_key), False
+        finally:
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+        return self.get(job_id), True
+
+    def claim(self, lease: float = OUTBOX_LEASE) -> Dict[str, Any]:
+        """Lease the next due job (queued, or sending with an expired lease) and return it with its payload"""
+        import uuid
+
+        owner = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._conn:
+            # A single UPDATE, so two processes can never claim the same job
+            claimed = self._conn.execute(
+                "UPDATE jobs SET status = 'sending', attempts = attempts + 1, lease_owner = ?, lease_until = ?, "
+                "updated_at = ? WHERE id = (SELECT id FROM jobs WHERE (status = 'queued' AND next_attempt_at <= ?) "
+                "OR (status = 'sending' AND lease_until < ?) ORDER BY next_attempt_at LIMIT 1)",
+                (owner, now + lease, now, now, now),
+            ).rowcount
+            if not claimed:
+                return None
+            row = self._conn.execute("SELECT * FROM jobs WHERE lease_owner = ?", (owner,)).fetchone()
+        job = job_from_row(row)
+        job["payload"] = json.loads(row["payload"])
+        job["lease_owner"] = owner
+        return job
+
+    def finish(self, job: Dict[str, Any], status: str, result: Dict[str, Any]):
+        """Record the final outcome (sent / failed) of a claimed job, without its credentials"""
+        payload = {key: value for key, value in job["payload"].items() if key not in OUTBOX_CREDENTIAL_KEYS}
+        self._update(job, "status = ?, result = ?, payload = ?, lease_owner = NULL, lease_until = NULL",
+                     (status, json.dumps(result), json.dumps(payload)))
+        if time.time() - self._purged_at >= OUTBOX_PURGE_INTERVAL:
+            self.purge()
+
+    def purge(self, retention: float = OUTBOX_RETENTION) -> int:
+        """Delete jobs finished more than `retention` seconds ago and return how many"""
+        import sqlite3
+
+        self._purged_at = time.time()
+        with self._lock, self._conn:
+            deleted = self._conn.execute(
+                "DELETE FROM jobs WHERE status IN ('sent', 'failed') AND updated_at < ?",
+                (time.time() - retention,)).rowcount
+            try:
+                # Finished jobs stored before credentials were stripped on finish
+                self._conn.execute(
+                    "UPDATE jobs SET payload = json_remove(payload, '$.sid_cookie', '$.user_agent') "
+                    "WHERE status IN ('sent', 'failed') AND json_extract(payload, '$.sid_cookie') IS NOT NULL")
+            except sqlite3.OperationalError:
+                pass  # SQLite without JSON functions
+        return deleted
+
+    def retry(self, job: Dict[str, Any], result: Dict[str, Any], delay: float):
+        """Put a claimed job back in the queue after a failed attempt"""
+        self._update(job, "status = 'queued', result = ?, next_attempt_at = ?, lease_owner = NULL, lease_until = NULL",
+                     (json.dumps(result), time.time() + delay))
+
+    def _update(self, job: Dict[str, Any], assignments: str, params: tuple):
+        with self._lock, self._conn:
+            # Only the current lease holder may update; a stale worker's outcome is dropped
+            self._conn.execute(
+                f"UPDATE jobs SET {assignments}, updated_at = ? WHERE id = ? AND lease_owner = ?",
+                params + (time.time(), job["job_id"], job["lease_owner"]),
+            )
+
+    def next_attempt(self, job_ids) -> float:
+        """Earliest retry time among the given jobs still queued, or None"""
+        job_ids = list(job_ids)
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT MIN(next_attempt_at) FROM jobs WHERE status = 'queued' "
+                f"AND id IN ({', '.join('?' * len(job_ids))})", job_ids).fetchone()
+        return row[0]
+
+    def get(self, job_id: str, account: str = None) -> Dict[str, Any]:
+        """Job by id, or None; with `account`, only that account's job"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or (account is not None and row["account"] != account):
+            return None
+        return job_from_row(row)
+
+    def find(self, account: str, idempotency_key: str) -> Dict[str, Any]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM jobs WHERE account = ? AND idempotency_key = ?", (account, idempotency_key)
+            ).fetchone()
+        return job_from_row(row) if row else None
+
+    def release_media(self, file_path: str):
+        """Delete a stored media file once no unfinished job needs it"""
+        with self._lock, self._conn:
+            # Same write lock as enqueue: a job referencing the file is either counted here or inserted after
+            self._conn.execute("BEGIN IMMEDIATE")
+            rows = self._conn.execute(
+                "SELECT payload FROM jobs WHERE kind = 'media' AND status IN ('queued', 'sending')"
+            ).fetchall()
+            if not any(json.loads(row["payload"]).get("file_path") == file_path for row in rows):
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+
+    def _stage_media(self, file_path: str, stored: str = None):
+        """(stored path, temporary copy or None when the stored file already exists)"""
+        import shutil
+        import tempfile
+
+        os.makedirs(self.media_dir, exist_ok=True)
+        if stored is None:
+            stored = os.path.join(self.media_dir, hash_file(file_path) + os.path.splitext(file_path)[1].lower())
+            if os.path.exists(stored):
+                return stored, None
+        fd, temp_path = tempfile.mkstemp(dir=self.media_dir, prefix='.staging-')
+        os.close(fd)
+        try:
+            shutil.copyfile(file_path, temp_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return stored, temp_path
+
+
+def job_from_row(row) -> Dict[str, Any]:
+    """Job row -> the job_status shape (credentials in the payload are never returned)"""
+    payload = json.loads(row["payload"])
+    return {
+        "job_id": row["id"],
+        "kind": row["kind"],
+        "number": payload.get("number"),
+        "status": row["status"],
+        "attempts": row["attempts"],
+        "idempotency_key": row["idempotency_key"],
+        "result": json.loads(row["result"]) if row["result"] else None,
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+    }
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def outbox_path() -> str:
+    return os.path.join(DATA_DIR, 'outbox.db')
+
+
+def get_outbox() -> Outbox:
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = Outbox(outbox_path())
+    return _outbox
+
+
+def deliver_job(outbox: Outbox, job: Dict[str, Any]) -> Dict[str, Any]:
+    """Make one delivery attempt for a claimed job and record the outcome"""
+    payload = job["payload"]
+    try:
+        service = TextNowService(payload["username"], payload["sid_cookie"], payload.get("user_agent"))
+        if job["kind"] == "media":
+            result = service.send_media(payload["number"], payload["file_path"])
+        else:
+            result = service.send_sms(payload["number"], payload["message"])
+    except Exception as e:
+        result = {"success": False, "error": str(e)}
+
+    error = result.get("error") or ""
+    if result.get("success"):
+        outbox.finish(job, "sent", result)
+    elif any(marker in error for marker in PERMANENT_SEND_ERRORS) or job["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+        outbox.finish(job, "failed", result)
+    else:
+        # Transient failure beyond what the scheduler already retried: back off for longer
+        outbox.retry(job, result, delay=min(300.0, 5.0 * 2 ** (job["attempts"] - 1)))
+        return result
+
+    if job["kind"] == "media":
+        outbox.release_media(payload["file_path"])
+    return result
+
+
+class OutboxWorkers:
+    """Threads draining the outbox; notify() wakes them after an enqueue"""
+
+    def __init__(self, outbox: Outbox, workers: int = OUTBOX_WORKERS):
+        self.outbox = outbox
+        self.workers = workers
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self) -> 'OutboxWorkers':
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def notify(self):
+        self._wakeup.set()
+
+    def stop(self, timeout: float = 10.0):
+        """Let in-flight deliveries finish; unclaimed jobs stay queued for the next start"""
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            job = self.outbox.claim()
+            if job is None:
+                self._wakeup.wait(OUTBOX_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            deliver_job(self.outbox, job)
+
+
+def drain_outbox(outbox: Outbox, max_jobs: int = None, follow_retries: bool = False) -> int:
+    """Deliver due jobs in this process until none are left (or `max_jobs` attempts were made)
+
+    With `follow_retries`, jobs this drain put back for a retry are waited for
+    and retried too, until each is sent or failed; without serve mode nothing
+    else would pick them up.
+    """
+    processed = 0
+    attempted = set()
+    while max_jobs is None or processed < max_jobs:
+        job = outbox.claim()
+        if job is None:
+            due = outbox.next_attempt(attempted) if follow_retries and attempted else None
+            if due is None:
+                break
+            time.sleep(min(max(0.0, due - time.time()), OUTBOX_LEASE))
+            continue
+        attempted.add(job["job_id"])
+        deliver_job(outbox, job)
+        processed += 1
+    return processed
+
+
+# Delivery workers of this process: serve mode starts them for an existing outbox,
+# or on the first enqueue, so the outbox is only created once something is queued
+outbox_workers = None
+outbox_workers_enabled = False
+_outbox_workers_lock = threading.Lock()
+
+
+def ensure_outbox_workers() -> OutboxWorkers:
+    """This process's delivery workers, started on first use; None outside serve mode"""
+    global outbox_workers
+    if not outbox_workers_enabled or OUTBOX_WORKERS <= 0:
+        return None
+    with _outbox_workers_lock:
+        if outbox_workers is None:
+            outbox_workers = OutboxWorkers(get_outbox()).start()
+    return outbox_workers
+
+
+# Media download cache: total size before LRU eviction, largest single file, read/write chunk size
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get('TEXTNOW_MEDIA_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+MEDIA_MAX_FILE_BYTES = int(os.environ.get('TEXTNOW_MEDIA_MAX_FILE_BYTES', str(100 * 1024 * 1024)))
+MEDIA_CHUNK_SIZE = 64 * 1024
+# Port of the local media endpoint in serve mode (unset: no endpoint, 0: any free port)
+MEDIA_PORT = os.environ.get('TEXTNOW_MEDIA_PORT')
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+# Hosts (with their subdomains) media may come from besides TextNow's, e.g. a CDN it redirects to
+MEDIA_HOSTS = tuple(host.strip().lower() for host in os.environ.get('TEXTNOW_MEDIA_HOSTS', '').split(',')
+                    if host.strip())
+MEDIA_MAX_REDIRECTS = 3
+
+
+def textnow_host() -> str:
+    """TextNow's domain (TEXTNOW_BASE_URL's host without www.)"""
+    from urllib.parse import urlparse
+
+    host = (urlparse(TEXTNOW_BASE_URL).hostname or '').lower()
+    return host[4:] if host.startswith('www.') else host
+
+
+def host_within(host: str, domain: str) -> bool:
+    return host == domain or host.endswith('.' + domain)
+
+
+def media_host_allowed(url: str) -> bool:
+    """Whether `url` is http(s) on TextNow's domain or a TEXTNOW_MEDIA_HOSTS entry"""
+    from urllib.parse import urlparse
+
+    parsed = urlparse(url)
+    host = (parsed.hostname or '').lower()
+    if parsed.scheme not in ('http', 'https') or not host:
+        return False
+    return any(host_within(host, domain) for domain in (textnow_host(),) + MEDIA_HOSTS)
+
+
+def media_path_allowed(url: str) -> bool:
+    """Whether `url`'s path is outside TextNow's API (/api/...), which is never fetched as media"""
+    from urllib.parse import unquote, urlparse
+
+    # Resolve '.', '..' and empty segments the way the server would before comparing
+    segments = []
+    for segment in unquote(urlparse(url).path).replace('\\', '/').split('/'):
+        if segment == '..':
+            if segments:
+                segments.pop()
+        elif segment not in ('', '.'):
+            segments.append(segment)
+    return not segments or segments[0].lower() != 'api'
+
+
+class MediaCache:
+    """Content-addressed disk cache of downloaded media with size-bounded LRU eviction
+
+    Files are stored once per content hash (sha256) under <directory>/<2 hex>/,
+    however many URLs point at them. An SQLite index maps (account, URL) to
+    hashes, so one account's downloads are never served to another, and
+    tracks sizes and last access; once the total goes over `max_bytes`, the
+    least recently used files are deleted. Downloads stream to a temporary
+    file, never into memory. Several processes can share the directory.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS media_objects (
+            digest TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            content_type TEXT,
+            last_access REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS media_objects_lru ON media_objects (last_access);
+        CREATE TABLE IF NOT EXISTS media_urls (
+            account TEXT NOT NULL,
+            url TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            PRIMARY KEY (account, url)
+        );
+    """
+
+    def __init__(self, directory: str, max_bytes: int = MEDIA_CACHE_MAX_BYTES,
+                 max_file_bytes: int = MEDIA_MAX_FILE_BYTES):
+        import sqlite3
+
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(directory, 'index.db'), check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(media_urls)")}
+        if columns and "account" not in columns:
+            # URL index from before it was per account: drop it, the files are found again by hash
+            self._conn.execute("DROP TABLE media_urls")
+        self._conn.executescript(self.SCHEMA)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def lookup(self, account: str, url: str) -> Dict[str, Any]:
+        """Cached entry for `url` as downloaded by `account` (marked as used), or None"""
+        with self._lock:
+            row = self._conn.execute("SELECT digest FROM media_urls WHERE account = ? AND url = ?",
+                                     (account, url)).fetchone()
+        return self.get(row["digest"]) if row is not None else None
+
+    def get(self, digest: str) -> Dict[str, Any]:
+        """Cached entry for a content hash (marked as used), or None"""
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT digest, size, content_type FROM media_objects WHERE digest = ?",
+                                     (digest,)).fetchone()
+            if row is None:
+                return None
+            path = self.path(digest)
+            if not os.path.exists(path):
+                # Deleted behind our back: forget it and download again
+                self._forget(digest)
+                return None
+            self._conn.execute("UPDATE media_objects SET last_access = ? WHERE digest = ?", (time.time(), digest))
+        return {"sha256": digest, "size": row["size"], "content_type": row["content_type"], "path": path}
+
+    def store(self, account: str, url: str, chunks, content_type: str = None) -> Dict[str, Any]:
+        """Write streamed `chunks` (bytes) to the cache for `account`'s `url` and return its entry"""
+        import tempfile
+
+        digest = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.download-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_file_bytes:
+                        raise ValueError(f"Media is larger than {self.max_file_bytes} bytes")
+                    digest.update(chunk)
+                    f.write(chunk)
+            digest = digest.hexdigest()
+            path = self.path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Atomic: readers see the whole file or none (identical content if it already exists)
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO media_objects (digest, size, content_type, last_access) VALUES (?, ?, ?, ?)",
+                (digest, size, content_type, time.time()))
+            self._conn.execute("INSERT OR REPLACE INTO media_urls (account, url, digest) VALUES (?, ?, ?)",
+                               (account, url, digest))
+            self._evict(keep=digest)
+        return {"sha256": digest, "size": size, "content_type": content_type, "path": path}
+
+    def _evict(self, keep: str = None):
+        """Delete least recently used files until the cache fits in max_bytes (caller holds the lock)"""
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM media_objects").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for row in self._conn.execute("SELECT digest, size FROM media_objects ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            if row["digest"] == keep:
+                continue
+            self._forget(row["digest"])
+            try:
+                os.remove(self.path(row["digest"]))
+            except OSError:
+                pass
+            total -= row["size"]
+
+    def _forget(self, digest: str):
+        self._conn.execute("DELETE FROM media_objects WHERE digest = ?", (digest,))
+        self._conn.execute("DELETE FROM media_urls WHERE digest = ?", (digest,))
+
+
+_media_cache = None
+_media_cache_lock = threading.Lock()
+
+
+def get_media_cache() -> MediaCache:
+    global _media_cache
+    with _media_cache_lock:
+        if _media_cache is None:
+            _media_cache = MediaCache(os.path.join(DATA_DIR, 'media_cache'))
+    return _media_cache
+
+
+# Concurrent fetch_media calls of an account for the same URL share one download
+media_flight = SingleFlight()
+
+
+def parse_range(header: str, size: int):
+    """(start, end) inclusive for a single-range `Range: bytes=...` header
+
+    Returns None when the header is absent or not a single byte range (serve
+    the whole file), and raises ValueError when the range is unsatisfiable.
+    """
+    match = re.match(r'^bytes=(\d*)-(\d*)$', (header or '').strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        # Suffix range: the last N bytes
+        start = max(0, size - int(last))
+        end = size - 1
+    if start > end or start >= size:
+        raise ValueError(f"Range not satisfiable for {size} bytes")
+    return start, end
+
+
+class MediaServer:
+    """Local HTTP endpoint serving cached media in serve mode: GET /media/<sha256>
+
+    Supports HEAD, Range requests (206) and ETag revalidation. Content is
+    addressed by hash, so responses never change and may be cached forever.
+    Only files already fetched with fetch_media are served; it binds to
+    127.0.0.1 and never contacts TextNow.
+    """
+
+    def __init__(self, cache: MediaCache, port: int = 0, host: str = '127.0.0.1'):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.serve_media(send_body=False)
+
+            def do_GET(self):
+                self.serve_media(send_body=True)
+
+            def fail(self, status: int, headers: Dict[str, str] = None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def serve_media(self, send_body: bool):
+                digest = self.path.split('?', 1)[0][len('/media/'):] if self.path.startswith('/media/') else ''
+                entry = cache.get(digest) if DIGEST_RE.match(digest) else None
+                if entry is None:
+                    return self.fail(404)
+                etag = f'"{digest}"'
+                if self.headers.get('If-None-Match') == etag:
+                    return self.fail(304, {'ETag': etag})
+                size = entry["size"]
+                try:
+                    byte_range = parse_range(self.headers.get('Range'), size)
+                except ValueError:
+                    return self.fail(416, {'Content-Range': f'bytes */{size}'})
+                start, end = byte_range or (0, size - 1)
+                try:
+                    f = open(entry["path"], 'rb')
+                except OSError:
+                    return self.fail(404)
+                with f:
+                    self.send_response(206 if byte_range else 200)
+                    self.send_header('Content-Type', entry["content_type"] or 'application/octet-stream')
+                    self.send_header('Content-Length', str(end - start + 1))
+                    self.send_header('Accept-Ranges', 'bytes')
+                    self.send_header('ETag', etag)
+                    self.send_header('Cache-Control', 'private, max-age=31536000, immutable')
+                    if byte_range:
+                        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+                    self.end_headers()
+                    if not send_body:
+                        return
+                    f.seek(start)
+                    remaining = end - start + 1
+                    while remaining > 0:
+                        chunk = f.read(min(MEDIA_CHUNK_SIZE, remaining))
+                        if not chunk:
+                            break
+                        self.wfile.write(chunk)
+                        remaining -= len(chunk)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def url_for(self, digest: str) -> str:
+        return f'{self.url}/media/{digest}'
+
+    def start(self) -> 'MediaServer':
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# Media endpoint of this process, started by serve mode when TEXTNOW_MEDIA_PORT is set
+media_server = None
+
+
+def strip_ansi_codes(text: str) -> str:
+    """Remove ANSI escape codes from text"""
+    ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+    return ansi_escape.sub('', text)
+
+class CommandError(Exception):
+    """Invalid or incomplete command input (reported as {"error": ...})"""
+
+
+# Set when serve mode is shutting down, so long-running commands (watch) return
+shutdown_event = threading.Event()
+
+
+def get_service(input_data: Dict[str, Any], timings=NULL_TIMINGS) -> TextNowService:
+    """Build a TextNowService for the request credentials
+
+    Services are cheap: the per-account HTTP session behind them comes from
+    `session_registry`, so a long-running worker reuses warm connections.
+    """
+    username = input_data.get("username")
+    sid_cookie = input_data.get("sid_cookie")
+    user_agent = input_data.get("user_agent")  # User agent from browser (required per GitHub issue #39)
+
+    if not username or not sid_cookie:
+        raise CommandError("Missing username or sid_cookie")
+
+    with timings.phase("init"):
+        return TextNowService(username, sid_cookie, user_agent, timings=timings)
+
+
+def stream_messages(records, emit, diagnostics: Dict[str, Any] = None) -> Dict[str, Any]:
+    """Emit each message as its own {"message": ...} record and return the trailing summary
+
+    Error records from iter_messages, and diagnostics if any, go into the summary instead.
+    """
+    summary = {"count": 0}
+    for record in records:
+        if "error" in record:
+            summary["error"] = record["error"]
+        else:
+            emit({"message": record})
+            summary["count"] += 1
+    if diagnostics:
+        summary["diagnostics"] = diagnostics
+    return {"summary": summary}
+
+
+def dump_result(result: Dict[str, Any], timings=NULL_TIMINGS) -> str:
+    """Serialize a command result, timing it and appending the request timings when reported"""
+    if not timings.enabled:
+        return json.dumps(result, ensure_ascii=False)
+    with timings.phase("serialize"):
+        output = json.dumps(result, ensure_ascii=False)
+    timings.add("total", time.perf_counter() - timings.started)
+    if not timings.report:
+        return output
+    # Splice the timings into the serialized object so they cover serializing the result itself
+    return output[:-1] + (', ' if result else '') + '"timings": ' + json.dumps(timings.as_dict()) + '}'
+
+
+def write_json_line(record: Dict[str, Any], stdout=None):
+    """Write one NDJSON record and flush it so consumers see it right away"""
+    stdout = stdout or sys.stdout
+    stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+    stdout.flush()
+
+
+def parse_batch_recipients(input_data: Dict[str, Any]) -> List[Dict[str, str]]:
+    """Recipients of a send_batch request as [{"number", "message"}]
+
+    `recipients` holds numbers (sent the top-level `message`) or objects with
+    their own `number` and optional `message`.
+    """
+    recipients = input_data.get("recipients")
+    default_message = input_data.get("message")
+    if not recipients or not isinstance(recipients, list):
+        raise CommandError("Missing recipients")
+
+    parsed = []
+    for recipient in recipients:
+        if isinstance(recipient, dict):
+            number = recipient.get("number")
+            message = recipient.get("message") or default_message
+        else:
+            number, message = recipient, default_message
+        if not number or not message:
+            raise CommandError(f"Missing number or message for recipient: {recipient}")
+        parsed.append({"number": str(number), "message": message})
+    return parsed
+
+
+def batch_response(results, emit=None) -> Dict[str, Any]:
+    """Collect per-recipient send results
+
+    With `emit` each result is streamed as a {"result": ...} record as it
+    completes and only the {"summary": ...} is returned; otherwise all results
+    are returned in recipient order.
+    """
+    summary = {"sent": 0, "failed": 0}
+    if emit is not None:
+        for result in results:
+            summary["sent" if result.get("success") else "failed"] += 1
+            emit({"result": result})
+        return {"summary": summary}
+    ordered = sorted(results, key=lambda result: result["index"])
+    for result in ordered:
+        summary["sent" if result.get("success") else "failed"] += 1
+    return dict(summary, success=summary["failed"] == 0, results=ordered)
+
+
+# Commands run_command knows (metrics label every other command "unknown")
+COMMANDS = frozenset({
+    "ping", "metrics", "process_outbox", "check_session", "fetch_media", "send_sms", "send_media", "send_batch",
+    "get_messages", "get_conversations", "list_threads", "search_messages", "enqueue_sms", "enqueue_media",
+    "job_status", "watch",
+})
+
+
+def run_command(command: str, input_data: Dict[str, Any], emit=None, timings=NULL_TIMINGS) -> Dict[str, Any]:
+    """Execute a single service command and return its JSON-serializable result
+
+    Streaming commands (`"stream": true`) send intermediate records through
+    `emit` and return only their final summary record. `timings` (see
+    new_timings) records the time spent in each phase of the request.
+    """
+    if command == "ping":
+        result = {"ok": True, "pid": os.getpid(), "sessions": len(session_registry)}
+        if media_server is not None:
+            result["media_url"] = media_server.url
+        return result
+    if command == "metrics":
+        return {"metrics": metrics.render()}
+    if command == "process_outbox":
+        max_jobs = input_data.get("max_jobs")
+        return {"processed": drain_outbox(get_outbox(), int(max_jobs) if max_jobs else None,
+                                          follow_retries=bool(input_data.get("follow_retries", True)))}
+
+    service = get_service(input_data, timings)
+
+    if command == "check_session":
+        return service.check_session(force=bool(input_data.get("force", False)))
+
+    elif command == "fetch_media":
+        url = input_data.get("url")
+        if not url:
+            raise CommandError("Missing url")
+        return service.fetch_media(str(url))
+
+    elif command == "send_sms":
+        number = input_data.get("number")
+        message = input_data.get("message")
+        if not number or not message:
+            raise CommandError("Missing number or message")
+        return service.send_sms(number, message)
+
+    elif command == "send_media":
+        number = input_data.get("number")
+        numbers = input_data.get("numbers")
+        file_path = input_data.get("file_path")
+        if numbers and file_path:
+            # Multi-recipient send: one upload, fanned out to every number
+            max_workers = min(int(input_data.get("max_workers", 4)), 16)
+            results = service.iter_send_media_batch([str(n) for n in numbers], file_path, max_workers=max_workers)
+            return batch_response(results, emit if input_data.get("stream") else None)
+        if not number or not file_path:
+            raise CommandError("Missing number or file_path")
+        return service.send_media(number, file_path)
+
+    elif command == "send_batch":
+        recipients = parse_batch_recipients(input_data)
+        max_workers = min(int(input_data.get("max_workers", 4)), 16)
+        results = service.iter_send_batch(recipients, max_workers=max_workers)
+        return batch_response(results, emit if input_data.get("stream") else None)
+
+    elif command == "get_messages":
+        number = input_data.get("number")
+        num_messages = input_data.get("num_messages", 50)
+        full_sync = bool(input_data.get("full_sync", False))
+        diagnostics = new_diagnostics(input_data)
+        paging = {"page_size": input_data.get("page_size"), "max_pages": input_data.get("max_pages")}
+        if input_data.get("stream") and emit is not None:
+            messages = service.iter_messages(number, num_messages, full_sync=full_sync, diagnostics=diagnostics, **paging)
+            return stream_messages(messages, emit, diagnostics)
+        messages = service.get_messages(number, num_messages, full_sync=full_sync, diagnostics=diagnostics, **paging)
+        result = {"messages": messages}
+        if diagnostics:
+            result["diagnostics"] = diagnostics
+        return result
+
+    elif command == "get_conversations":
+        numbers = input_data.get("numbers")
+        if not numbers or not isinstance(numbers, list):
+            raise CommandError("Missing numbers")
+        numbers = list(dict.fromkeys(str(number) for number in numbers))
+        conversations = service.iter_conversations(numbers, input_data.get("num_messages", 50),
+                                                   max_workers=min(int(input_data.get("max_workers", 8)), 16))
+        summary = {"fetched": 0, "failed": 0}
+        if input_data.get("stream") and emit is not None:
+            for conversation in conversations:
+                summary["failed" if "error" in conversation else "fetched"] += 1
+                emit({"conversation": conversation})
+            return {"summary": summary}
+        results = {}
+        for conversation in conversations:
+            summary["failed" if "error" in conversation else "fetched"] += 1
+            results[conversation.pop("number")] = conversation
+        # Keyed in request order, whatever order the fetches completed in
+        return dict(summary, conversations={number: results[number] for number in numbers})
+
+    elif command == "list_threads":
+        offset = max(0, int(input_data.get("offset", 0)))
+        limit = max(1, min(int(input_data.get("limit", 20)), 200))
+        include_ids = bool(input_data.get("include_ids", False))
+        store = get_message_store()
+        if store is None:
+            # No store to sync into: index a fresh fetch instead
+            index = ConversationIndex()
+            index.add(m for m in service.get_messages(None, input_data.get("num_messages", 200)) if "error" not in m)
+            return index.list_threads(offset, limit, include_ids)
+        # Incremental sync (num_messages=0: nothing is read back), which also updates the index
+        for record in service.iter_messages(None, 0):
+            if "error" in record:
+                raise CommandError(record["error"])
+        return get_conversation_index(service.username, store).list_threads(offset, limit, include_ids)
+
+    elif command == "search_messages":
+        query = input_data.get("query")
+        if not query:
+            raise CommandError("Missing query")
+        store = get_message_store()
+        if store is None:
+            raise CommandError("Search needs the message store (TEXTNOW_MESSAGE_STORE is disabled)")
+        if input_data.get("sync"):
+            for record in service.iter_messages(None, 0):
+                if "error" in record:
+                    raise CommandError(record["error"])
+        else:
+            # The stored history is only readable with credentials TextNow accepts
+            # (a recent check_session verdict, or one check now)
+            session = service.check_session()
+            if not session["valid"]:
+                raise CommandError(session["error"])
+        try:
+            return store.search(
+                service.username, query,
+                number=input_data.get("number"),
+                since=input_data.get("since"),
+                until=input_data.get("until"),
+                limit=max(1, min(int(input_data.get("limit", 20)), 200)),
+                offset=max(0, int(input_data.get("offset", 0))),
+                order="relevance" if input_data.get("order") == "relevance" else "date",
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+    elif command in ("enqueue_sms", "enqueue_media"):
+        number = input_data.get("number")
+        payload = {"username": service.username, "sid_cookie": service.sid_cookie,
+                   "user_agent": service.user_agent, "number": number}
+        if command == "enqueue_sms":
+            if not number or not input_data.get("message"):
+                raise CommandError("Missing number or message")
+            kind, payload["message"] = "sms", input_data["message"]
+        else:
             file_path = input_data.get("file_path")
             if not number or not file_path:
-                error_msg = json.dumps({"error": "Missing number or file_path"})
-                print(error_msg)
-                sys.exit(1)
-            result = service.send_media(number, file_path)
-            output = json.dumps(result, ensure_ascii=False)
-            print(output)
-        
-        elif command == "get_messages":
-            number = input_data.get("number")
-            num_messages = input_data.get("num_messages", 50)
-            messages = service.get_messages(number, num_messages)
-            output = json.dumps({"messages": messages}, ensure_ascii=False)
-            print(output)
-        
-        else:
-            error_msg = json.dumps({"error": f"Unknown command: {command}"})
+                raise CommandError("Missing number or file_path")
+            if not os.path.exists(file_path):
+                raise CommandError(f"File not found: {file_path}")
+            kind = "media"
+        # Reject what could never be delivered now, rather than as a failed job later
+        validate_phone_number(number)
+        outbox = get_outbox()
+        job, created = outbox.enqueue(service.username, kind, payload, input_data.get("idempotency_key"),
+                                      media_file=file_path if kind == "media" else None)
+        workers = ensure_outbox_workers()
+        if workers is not None:
+            workers.notify()
+        return {"job_id": job["job_id"], "status": job["status"], "duplicate": not created}
+
+    elif command == "job_status":
+        outbox = get_outbox()
+        # Jobs are only visible to the account that enqueued them
+        if input_data.get("job_ids"):
+            return {"jobs": {str(job_id): outbox.get(str(job_id), account=service.username)
+                             for job_id in input_data["job_ids"]}}
+        if not input_data.get("job_id"):
+            raise CommandError("Missing job_id or job_ids")
+        job = outbox.get(str(input_data["job_id"]), account=service.username)
+        if job is None:
+            raise CommandError(f"Unknown job: {input_data['job_id']}")
+        return {"job": job}
+
+    elif command == "watch":
+        if emit is None:
+            raise CommandError("watch streams NDJSON events and needs an output stream")
+        min_interval = max(0.1, float(input_data.get("min_interval", WATCH_MIN_INTERVAL)))
+        duration = input_data.get("duration")
+        max_polls = input_data.get("max_polls")
+        events = service.iter_watch(
+            input_data.get("number"),
+            int(input_data.get("num_messages", 50)),
+            min_interval=min_interval,
+            max_interval=max(min_interval, float(input_data.get("max_interval", WATCH_MAX_INTERVAL))),
+            duration=float(duration) if duration is not None else None,
+            max_polls=int(max_polls) if max_polls is not None else None,
+            include_existing=input_data.get("include_existing", True),
+            stop_event=shutdown_event,
+        )
+        summary = {"events": 0}
+        for event in events:
+            if event["event"] == "stopped":
+                summary.update(polls=event["polls"], reason=event["reason"])
+                continue
+            if event["event"] != "error":
+                summary["events"] += 1
+            emit(event)
+        return {"summary": summary}
+
+    raise CommandError(f"Unknown command: {command}")
+
+
+def serve(stdin=None, stdout=None, workers: int = None, supervised: bool = False):
+    """Long-running worker mode
+
+    Reads newline-delimited JSON requests from stdin and writes one JSON
+    response per line to stdout, until stdin is closed. Each request carries
+    the usual command payload plus a `command` field and an optional `id`,
+    which is echoed back so callers can match responses:
+
+        {"id": 1, "command": "send_sms", "username": ..., "sid_cookie": ..., "number": ..., "message": ...}
+        {"id": 1, "success": true, "message": "Message sent successfully"}
+
+    Streaming requests answer with several lines carrying the same `id`, the
+    last one being the {"summary": ...} record.
+
+    Requests are handled by a pool of `workers` threads (TEXTNOW_SERVE_WORKERS,
+    default 8), so responses may arrive out of order. Account sessions are
+    isolated, so requests for different accounts can run side by side.
+    `ping` is answered right away, even when every worker thread is busy.
+
+    Under supervise(), the final response of each request is marked with
+    `"_done": true` so the supervisor knows when a stream has ended.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    global outbox_workers_enabled, media_server
+    workers = workers or int(os.environ.get('TEXTNOW_SERVE_WORKERS', '8'))
+    write_lock = threading.Lock()
+    outbox_workers_enabled = True
+    if os.path.exists(outbox_path()):
+        # Picks up jobs left over from before a restart
+        ensure_outbox_workers()
+    if MEDIA_PORT:
+        media_server = MediaServer(get_media_cache(), int(MEDIA_PORT)).start()
+
+    def handle(line: str):
+        request_id = None
+        command = None
+        timings = NULL_TIMINGS
+
+        def emit(record: Dict[str, Any]):
+            if request_id is not None:
+                record = dict(record, id=request_id)
+            with write_lock:
+                write_json_line(record, stdout)
+
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise CommandError("Request must be a JSON object")
+            request_id = request.get("id")
+            command = request.get("command")
+            timings = new_timings(request, collect=METRICS_ENABLED)
+            result = run_command(command, request, emit, timings)
+        except json.JSONDecodeError as e:
+            result = {"error": f"Invalid JSON input: {str(e)}"}
+        except Exception as e:
+            result = {"error": str(e)}
+
+        if request_id is not None:
+            result = dict(result, id=request_id)
+        if supervised:
+            result = dict(result, _done=True)
+        output = dump_result(result, timings)
+        with write_lock:
+            stdout.write(output + "\n")
+            stdout.flush()
+        if METRICS_ENABLED and timings.enabled:
+            metrics.observe(command, timings, error="error" in result)
+
+    def is_ping(line: str) -> bool:
+        # Cheap pre-check: most lines are not pings and may be large
+        if '"ping"' not in line:
+            return False
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError:
+            return False
+        return isinstance(request, dict) and request.get("command") == "ping"
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for line in stdin:
+            line = line.strip()
+            if not line:
+                continue
+            if is_ping(line):
+                # Answered here, not queued behind long requests (watch streams, retry
+                # waits): the supervisor's health check must not mistake busy for hung
+                handle(line)
+            else:
+                pool.submit(handle, line)
+        shutdown_event.set()
+    if outbox_workers is not None:
+        outbox_workers.stop()
+    if media_server is not None:
+        media_server.stop()
+    if metrics.path:
+        metrics.write()
+
+
+# Supervisor: serve processes, queued requests per process before callers are turned away,
+# health check interval and how long a ping may take
+SUPERVISE_WORKERS = int(os.environ.get('TEXTNOW_SUPERVISE_WORKERS', '0')) or os.cpu_count() or 2
+SUPERVISE_MAX_QUEUE = int(os.environ.get('TEXTNOW_SUPERVISE_MAX_QUEUE', '64'))
+SUPERVISE_HEALTH_INTERVAL = float(os.environ.get('TEXTNOW_SUPERVISE_HEALTH_INTERVAL', '5'))
+SUPERVISE_HEALTH_TIMEOUT = float(os.environ.get('TEXTNOW_SUPERVISE_HEALTH_TIMEOUT', '15'))
+
+
+class WorkerProcess:
+    """One `serve --supervised` child of the supervisor, with its in-flight requests
+
+    Requests are sent with internal ids; `pending` maps them back to the
+    caller's id until the response marked `_done` arrives. If the process
+    exits, its pending requests fail and it is restarted with backoff.
+    """
+
+    HEALTH_CHECK = object()
+
+    def __init__(self, index: int, write):
+        self.index = index
+        self.write = write  # writes a response record to the supervisor's stdout
+        self.process = None
+        self.pending = {}  # internal id -> caller's id (None: no id; HEALTH_CHECK: our ping)
+        self.restarts = 0
+        self.failures = 0  # consecutive crashes, for the restart backoff
+        self.last_healthy = time.monotonic()
+        self.ping_sent = None
+        self.stopping = False
+        self._next_id = 0
+        self._lock = threading.Lock()
+        # Serializes stdin writes (dispatcher and health monitor threads); separate
+        # from _lock so a full pipe never blocks the reader
+        self._write_lock = threading.Lock()
+        self.reader = None
+
+    def start(self):
+        import subprocess
+
+        env = dict(os.environ)
+        if MEDIA_PORT and int(MEDIA_PORT):
+            # One media endpoint per process: consecutive ports
+            env['TEXTNOW_MEDIA_PORT'] = str(int(MEDIA_PORT) + self.index)
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'serve', '--supervised'],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, text=True, bufsize=1, env=env)
+        self.last_healthy = time.monotonic()
+        self.ping_sent = None
+        self.reader = threading.Thread(target=self._read, args=(self.process,), daemon=True)
+        self.reader.start()
+        return self
+
+    @property
+    def depth(self) -> int:
+        return len(self.pending)
+
+    def submit(self, request: Dict[str, Any], caller_id) -> bool:
+        """Forward a request; False if the process is not accepting it"""
+        with self._lock:
+            self._next_id += 1
+            internal_id = self._next_id
+            self.pending[internal_id] = caller_id
+            process = self.process
+        line = json.dumps(dict(request, id=internal_id)) + "\n"
+        try:
+            with self._write_lock:
+                process.stdin.write(line)
+                process.stdin.flush()
+            return True
+        except (OSError, ValueError):
+            with self._lock:
+                self.pending.pop(internal_id, None)
+            return False
+
+    def check_health(self):
+        """Ping the process; kill it if the previous ping went unanswered too long"""
+        if self.stopping or self.process is None or self.process.poll() is not None:
+            return
+        if self.ping_sent is not None:
+            if time.monotonic() - self.ping_sent > SUPERVISE_HEALTH_TIMEOUT:
+                self.process.kill()  # the reader sees EOF and restarts it
+            return
+        self.ping_sent = time.monotonic()
+        self.submit({"command": "ping"}, self.HEALTH_CHECK)
+
+    def _read(self, process):
+        for line in process.stdout:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            internal_id = record.pop("id", None)
+            done = record.pop("_done", False)
+            with self._lock:
+                caller_id = self.pending.pop(internal_id, None) if done else self.pending.get(internal_id)
+            if caller_id is self.HEALTH_CHECK:
+                self.ping_sent = None
+                self.last_healthy = time.monotonic()
+                self.failures = 0
+                continue
+            if done:
+                # Backpressure signal: requests still queued on this worker
+                record["queue_depth"] = self.depth
+            if caller_id is not None:
+                record["id"] = caller_id
+            self.write(record)
+
+        process.wait()
+        with self._lock:
+            lost, self.pending = self.pending, {}
+        for caller_id in lost.values():
+            if caller_id is self.HEALTH_CHECK:
+                continue
+            record = {"error": f"Worker {self.index} exited (code {process.returncode}) before responding"}
+            if caller_id is not None:
+                record["id"] = caller_id
+            self.write(record)
+        if not self.stopping:
+            self.failures += 1
+            self.restarts += 1
+            time.sleep(min(30.0, 0.5 * 2 ** (self.failures - 1)))
+            if not self.stopping:
+                self.start()
+
+    def stop(self):
+        """Let the process finish its requests and exit (serve returns when stdin closes)"""
+        self.stopping = True
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+    def status(self) -> Dict[str, Any]:
+        alive = self.process is not None and self.process.poll() is None
+        return {
+            "worker": self.index,
+            "pid": self.process.pid if self.process is not None else None,
+            "alive": alive,
+            "healthy": alive and time.monotonic() - self.last_healthy <= SUPERVISE_HEALTH_INTERVAL + SUPERVISE_HEALTH_TIMEOUT,
+            "queue_depth": self.depth,
+            "restarts": self.restarts,
+        }
+
+
+def account_shard(username: str, shards: int) -> int:
+    """Stable worker index for an account (same in every run, unlike hash())"""
+    return zlib.crc32(username.encode()) % shards
+
+
+def supervise(stdin=None, stdout=None, workers: int = None):
+    """Multi-process worker mode: `serve` protocol, requests sharded over processes
+
+    Runs `workers` serve processes (TEXTNOW_SUPERVISE_WORKERS, default one per
+    CPU) and routes each request by its username, so an account's sessions,
+    caches and rate limits live in one process while accounts spread across
+    cores. Requests without a username go to the least busy process; `ping`
+    is answered by the supervisor with every worker's status.
+
+    Processes are pinged every TEXTNOW_SUPERVISE_HEALTH_INTERVAL seconds and
+    restarted when they exit or stop answering; their in-flight requests get
+    an error. Final responses carry `queue_depth`, the requests still queued
+    on that worker. A request for a worker with TEXTNOW_SUPERVISE_MAX_QUEUE
+    requests queued is rejected at once with `overloaded: true`.
+    """
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    write_lock = threading.Lock()
+
+    def write(record: Dict[str, Any]):
+        with write_lock:
+            write_json_line(record, stdout)
+
+    pool = [WorkerProcess(index, write).start() for index in range(workers or SUPERVISE_WORKERS)]
+    stopped = threading.Event()
+
+    def monitor():
+        while not stopped.wait(SUPERVISE_HEALTH_INTERVAL):
+            for worker in pool:
+                worker.check_health()
+
+    threading.Thread(target=monitor, daemon=True).start()
+
+    for line in stdin:
+        line = line.strip()
+        if not line:
+            continue
+        request_id = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise CommandError("Request must be a JSON object")
+            request_id = request.get("id")
+            if request.get("command") == "ping":
+                result = {"ok": True, "pid": os.getpid(), "workers": [worker.status() for worker in pool]}
+            else:
+                username = request.get("username")
+                if username:
+                    worker = pool[account_shard(str(username), len(pool))]
+                else:
+                    worker = min(pool, key=lambda w: w.depth)
+                if worker.depth >= SUPERVISE_MAX_QUEUE:
+                    result = {"error": f"Worker {worker.index} is overloaded, retry later", "overloaded": True,
+                              "queue_depth": worker.depth}
+                elif worker.submit(request, request_id):
+                    continue
+                else:
+                    result = {"error": f"Worker {worker.index} is restarting, retry later", "overloaded": True,
+                              "queue_depth": worker.depth}
+        except json.JSONDecodeError as e:
+            result = {"error": f"Invalid JSON input: {str(e)}"}
+        except Exception as e:
+            result = {"error": str(e)}
+        if request_id is not None:
+            result = dict(result, id=request_id)
+        write(result)
+
+    stopped.set()
+    for worker in pool:
+        worker.stop()
+    for worker in pool:
+        # Each process drains its requests before exiting; its reader forwards the responses
+        worker.reader.join()
+
+
+def main():
+    """CLI interface for the service"""
+    if len(sys.argv) < 2:
+        error_msg = json.dumps({"error": "Invalid arguments"})
+        print(error_msg)
+        sys.exit(1)
+
+    command = sys.argv[1]
+    started_at = time.time()
+
+    if command == "serve":
+        serve(supervised="--supervised" in sys.argv[2:])
+        return
+    if command == "supervise":
+        supervise()
+        return
+
+    try:
+        # Read input from stdin
+        stdin_data = sys.stdin.read()
+        if not stdin_data:
+            error_msg = json.dumps({"error": "No input data provided"})
             print(error_msg)
             sys.exit(1)
-    
+
+        input_data = json.loads(stdin_data)
+        timings = new_timings(input_data)
+        if timings.enabled:
+            # Process startup as seen by the caller (`spawned_at`: epoch milliseconds at spawn)
+            timings.add("imports", IMPORT_SECONDS)
+            if input_data.get("spawned_at"):
+                timings.add("startup", max(0.0, started_at - float(input_data["spawned_at"]) / 1000))
+        # With "stream": true, records are written as NDJSON while they are produced
+        result = run_command(command, input_data, write_json_line, timings)
+        # Ensure clean JSON output without any extra formatting
+        output = dump_result(result, timings)
+        print(output)
+
     except json.JSONDecodeError as e:
         error_msg = json.dumps({"error": f"Invalid JSON input: {str(e)}"})
         print(error_msg)
@@ -558,4 +3721,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-